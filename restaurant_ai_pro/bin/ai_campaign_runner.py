@@ -4,124 +4,337 @@
 全店舗ランナー
 - shops.yaml を読み、店舗ごとに .env.<shopId> をロードして本体を実行
 - 1店舗失敗しても他店舗は継続（障害分離）
-- 店舗別ログ logs/<shopId>.log に STDOUT/STDERR/EXIT を蓄積
+- 店舗別ログ logs/<shopId>.log に STDOUT/STDERR/EXIT を逐次追記
 - DISABLE_BROADCAST=1 で一斉配信を全体停止
 - --only <shopId> で対象店舗を絞り込み可能
+- --jobs N で店舗を並列実行（asyncio で子プロセスを待つので、店舗数が増えてもスレッドは1本）
+- 同日中に配信済みで子のクールダウン中、かつ入力（daily/menu CSV・コマンド・店舗 .env）が
+  その配信時から変わっていなければスキップ（--force で無効化）
 """
 import os
 import sys
-import subprocess
+import json
+import shlex
+import time
+import copy
+import atexit
+import hashlib
+import asyncio
+import functools
 import pathlib
 import datetime as dt
 import argparse
+from collections import OrderedDict
+from dataclasses import dataclass, fields
 import yaml
-from dotenv import load_dotenv
+from dotenv import dotenv_values
+
+try:  # libyaml があれば C 実装のパーサを使う
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 ROOT = pathlib.Path(__file__).resolve().parents[1]   # プロジェクト直下
 BIN  = ROOT.joinpath("bin")
+CONFIG_DIRS = (ROOT.joinpath("config"), BIN.joinpath("config"))
+STATE_DIR = ROOT.joinpath(".state")
+
+# 起動コマンドの不変部分
+_PY = sys.executable
+_SCRIPT = str(BIN / "ai2_weekly_line_campaign.py")
+
+# -v/--verbose 指定時のみ INFO/DEBUG を店舗ログに出す（main で設定）
+VERBOSE = False
+
+# 子プロセス共通の環境（起動時に1回だけ組み立てる）
+_BASE_ENV = {
+    **os.environ,
+    "PYTHONPATH": str(ROOT),   # bin外からも restaurant_ai を import できるように
+    "MPLBACKEND": "Agg",
+}
+
+# load_yaml の結果キャッシュ: path -> (st_mtime_ns, st_size, parsed)
+_YAML_CACHE: "OrderedDict[str, tuple[int, int, dict]]" = OrderedDict()
+_YAML_CACHE_MAX = 100
 
+# .env.<shopId> のパース結果キャッシュ: path -> (st_mtime_ns, st_size, values)
+_DOTENV_CACHE: dict[str, tuple[int, int, dict]] = {}
+
+# 店舗別ログの fd（O_APPEND で開きっぱなしにして使い回す）
+_LOG_FDS: dict[str, int] = {}
+
+@dataclass(slots=True, frozen=True)
+class ShopSpec:
+    """shops.yaml の1店舗分（ランナーが使う項目だけ、既定値適用済み）"""
+    id: str
+    daily_csv: str
+    outdir: str
+    city: str = ""
+    coupon_url: str = "https://lin.ee/coupon"
+    threshold: float = 0.95
+    cooldown_hours: int = 24
+    broadcast: bool = False
+    menu_csv: str | None = None
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "ShopSpec":
+        missing = [k for k in ("id", "daily_csv", "outdir") if k not in d]
+        if missing:
+            raise ValueError(f"shop {d.get('id', '?')}: missing {', '.join(missing)}")
+        names = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in names})
+
+@functools.lru_cache(maxsize=256)
 def find_config_path(relpath: str) -> pathlib.Path:
     """
     config は ①ROOT/config ②ROOT/bin/config の順で探索
+    1回の実行中に config の配置は変わらないので結果をキャッシュする
     """
-    p1 = ROOT.joinpath("config", relpath)
+    p1 = CONFIG_DIRS[0].joinpath(relpath)
     if p1.exists():
         return p1
-    p2 = BIN.joinpath("config", relpath)
+    p2 = CONFIG_DIRS[1].joinpath(relpath)
     if p2.exists():
         return p2
     return p1  # デフォルトは ROOT/config 側（存在しなければ open 時に例外）
 
 def load_yaml(path: pathlib.Path) -> dict:
+    """
+    (path, mtime, size) が変わっていなければ前回のパース結果を返す
+    呼び出し側が cfg["shops"] を書き換えても壊れないよう deepcopy で渡す
+    """
+    st = pathlib.Path(path).stat()
+    key = str(path)
+    hit = _YAML_CACHE.get(key)
+    if hit is not None and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+        _YAML_CACHE.move_to_end(key)
+        return copy.deepcopy(hit[2])
+
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        data = yaml.load(f, Loader=_YamlLoader)
+    _YAML_CACHE[key] = (st.st_mtime_ns, st.st_size, data)
+    _YAML_CACHE.move_to_end(key)
+    while len(_YAML_CACHE) > _YAML_CACHE_MAX:
+        _YAML_CACHE.popitem(last=False)
+    return copy.deepcopy(data)
+
+def _cached_dotenv(path: pathlib.Path) -> dict:
+    """
+    dotenv_values を (path, mtime, size) でキャッシュ
+    os.environ は汚さないので、店舗間で値が漏れない
+    """
+    st = path.stat()
+    key = str(path)
+    hit = _DOTENV_CACHE.get(key)
+    if hit is not None and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+        return hit[2]
+    vals = {k: v for k, v in dotenv_values(path).items() if v is not None}
+    _DOTENV_CACHE[key] = (st.st_mtime_ns, st.st_size, vals)
+    return vals
+
+def _now_ts() -> str:
+    """ログ用タイムスタンプ（YYYY-MM-DDTHH:MM:SS、ローカル時刻）"""
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
 
 def log_path(shop_id: str) -> pathlib.Path:
     logs = ROOT.joinpath("logs")
     logs.mkdir(parents=True, exist_ok=True)
     return logs.joinpath(f"{shop_id}.log")
 
-def run_shop(shop: dict):
-    sid = shop["id"]
+def _get_log(shop_id: str) -> int:
+    """
+    店舗ログを O_APPEND で1度だけ開き、fd を使い回す
+    子プロセスも同じ fd に直接書くので、親側はバッファしない
+    """
+    fd = _LOG_FDS.get(shop_id)
+    if fd is None:
+        fd = os.open(str(log_path(shop_id)), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        _LOG_FDS[shop_id] = fd
+    return fd
+
+def _log_write(shop_id: str, *parts: str):
+    """複数パーツを writev で1回の追記にまとめる（O_APPEND なので追記単位でアトミック）"""
+    os.writev(_get_log(shop_id), [p.encode("utf-8") for p in parts])
+
+def _close_logs():
+    for fd in _LOG_FDS.values():
+        os.close(fd)
+    _LOG_FDS.clear()
+
+atexit.register(_close_logs)
+
+def _inputs_fingerprint(shop: ShopSpec, cmd: list, env_vals: dict) -> str | None:
+    """
+    daily_csv / menu_csv の (path, mtime, size)・起動コマンド・店舗 .env の値・当日の日付からハッシュを作る
+    日付を含めるのは、入力が同じでも天気・曜日で翌日の配信判定が変わるため
+    .env を含めるのは、トークンや設定を差し替えたら次の実行で反映させるため
+    入力が読めなければ None（スキップしない）
+    """
+    parts = [dt.date.today().isoformat(), shlex.join(cmd)]
+    parts += [f"{k}={v}" for k, v in sorted(env_vals.items())]
+    for rel in (shop.daily_csv, shop.menu_csv):
+        if not rel:
+            continue
+        path = ROOT / rel
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        parts.append(f"{path}:{st.st_mtime_ns}:{st.st_size}")
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+def _stat_key(path: pathlib.Path) -> tuple | None:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _cooldown_active(state_path: pathlib.Path, hours: int) -> bool:
+    """
+    子が配信時に state_dir/broadcast.json へ残す last_broadcast_at から、子自身のクールダウン中かを判定
+    （子の passed_cooldown と同じ基準。クールダウン中の子は天気や曜日に関係なく配信しない）
+    """
+    if hours <= 0:
+        return False
+    try:
+        last = dt.datetime.fromisoformat(json.loads(state_path.read_text(encoding="utf-8"))["last_broadcast_at"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    delta = dt.datetime.now().astimezone() - last.astimezone()
+    return delta.total_seconds() < hours * 3600
+
+async def run_shop(shop: ShopSpec, sem: asyncio.Semaphore, force: bool = False):
+    sid = shop.id
 
     # 1) 店舗ごとの .env をロード（あれば）
     env_file = find_config_path(f".env.{sid}")
     if env_file.exists():
-        load_dotenv(env_file)  # ← 外部ライブラリの load_dotenv
-        print(f"[INFO] loaded {env_file}")
+        vals = _cached_dotenv(env_file)
+        if VERBOSE:
+            _log_write(sid, f"[INFO] loaded {env_file}\n")
     else:
-        print(f"[WARN] missing {env_file} (continue)")
-    print(f"[DEBUG] shop={shop['id']} threshold={shop.get('threshold')} cooldown={shop.get('cooldown_hours')} broadcast={shop.get('broadcast')}")
+        vals = {}
+        _log_write(sid, f"[WARN] missing {env_file} (continue)\n")
+    if VERBOSE:
+        _log_write(sid, f"[DEBUG] shop={sid} threshold={shop.threshold} cooldown={shop.cooldown_hours} broadcast={shop.broadcast}\n")
 
     # 2) 起動コマンドを構築
     cmd = [
-        sys.executable, str(BIN.joinpath("ai2_weekly_line_campaign.py")),
-        "--daily_csv", shop["daily_csv"],
-        "--outdir",    shop["outdir"],
-        "--city",      shop.get("city", ""),
-        "--coupon_url",shop.get("coupon_url", "https://lin.ee/coupon"),
-        "--threshold", str(shop.get("threshold", 0.95)),
-        "--cooldown_hours", str(shop.get("cooldown_hours", 24)),
-        "--state_dir", str(ROOT.joinpath(".state", sid)),
+        _PY, _SCRIPT,
+        "--daily_csv", shop.daily_csv,
+        "--outdir",    shop.outdir,
+        "--city",      shop.city,
+        "--coupon_url",shop.coupon_url,
+        "--threshold", str(shop.threshold),
+        "--cooldown_hours", str(shop.cooldown_hours),
+        "--state_dir", str(STATE_DIR / sid),
         "--only_coupon",          # 顧客向け運用（週報テキストは送らない）
         # 必要に応じて --dry_run をここに付け足して検証も可
     ]
 
-    if "menu_csv" in shop:
-        cmd.extend(["--menu_csv", shop["menu_csv"]])
+    if shop.menu_csv is not None:
+        cmd.extend(["--menu_csv", shop.menu_csv])
 
         
+    # 3) 実行環境（店舗 .env は子プロセス用の env にだけ反映。既存の環境変数が優先）
+    env = {**vals, **_BASE_ENV} if vals else _BASE_ENV
+
     # broadcast 許可（緊急停止フラグ優先）
-    if shop.get("broadcast", False) and os.environ.get("DISABLE_BROADCAST", "0") != "1":
+    if shop.broadcast and env.get("DISABLE_BROADCAST", "0") != "1":
         cmd.append("--enable_broadcast")
 
-    # 3) 実行環境
-    env = os.environ.copy()
-    env["PYTHONPATH"] = str(ROOT)   # bin外からも restaurant_ai を import できるように
-    env["MPLBACKEND"] = "Agg"
-
-    # 4) 実行＆ログ
-    ts = dt.datetime.now().isoformat(timespec="seconds")
-    lp = log_path(sid)
-    with open(lp, "a", encoding="utf-8") as lg:
-        lg.write(f"\n[{ts}] RUN {sid}\nCMD: {' '.join(cmd)}\n")
+    # 4) 前回の配信時から入力が変わっておらず、子がまだクールダウン中ならスキップ
+    #    （子は exit 0 でも配信しないことがある。天気などで後から発火し得るので、配信していない日は毎回走らせる）
+    ts = _now_ts()
+    fp = _inputs_fingerprint(shop, cmd, vals)
+    fp_path = STATE_DIR / sid / "inputs.sha"
+    bc_path = STATE_DIR / sid / "broadcast.json"
+    if not force and fp is not None and _cooldown_active(bc_path, shop.cooldown_hours):
         try:
-            p = subprocess.run(cmd, cwd=str(ROOT), env=env,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               text=True, check=False)
-            if p.stdout:
-                lg.write(p.stdout)
-            if p.stderr:
-                lg.write("\n[STDERR]\n" + p.stderr)
-            lg.write(f"\nEXIT={p.returncode}\n")
-        except Exception as e:
-            lg.write(f"[EXC] {e}\n")
+            prev = fp_path.read_text(encoding="utf-8").strip()
+        except OSError:
+            prev = None
+        if prev == fp:
+            _log_write(sid, f"\n[{ts}] SKIP {sid} (inputs unchanged, cooldown active)\n")
+            return
+    bc_before = _stat_key(bc_path)
+
+    # 5) 実行＆ログ
+    # 親が書くのはヘッダとフッタの2回だけ（それぞれ writev 1回）
+    _log_write(sid, f"\n[{ts}] RUN {sid}\n", f"CMD: {shlex.join(cmd)}\n")
+    try:
+        # 子の STDOUT/STDERR はログ fd に直接流す（`>> log 2>&1` 相当）
+        async with sem:
+            p = await asyncio.create_subprocess_exec(
+                *cmd, cwd=str(ROOT), env=env,
+                stdout=_get_log(sid), stderr=asyncio.subprocess.STDOUT)
+            rc = await p.wait()
+        footer = f"\nEXIT={rc}\n"
+        # 子が broadcast.json を書いた（= 実際に配信した）ときだけ、その時点の入力を記録する
+        if rc == 0 and fp is not None and _stat_key(bc_path) != bc_before:
+            fp_path.parent.mkdir(parents=True, exist_ok=True)
+            fp_path.write_text(fp + "\n", encoding="utf-8")
+    except Exception as e:
+        footer = f"[EXC] {e}\n"
+    _log_write(sid, footer)
+
+async def run_all(targets: list, jobs: int, force: bool):
+    sem = asyncio.Semaphore(jobs)
+    results = await asyncio.gather(*(run_shop(s, sem, force) for s in targets),
+                                   return_exceptions=True)
+    for shop, res in zip(targets, results):
+        if isinstance(res, Exception):
+            _log_write(shop.id, f"\n[{_now_ts()}] FATAL {res}\n")
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", default="config/shops.yaml",
                     help="shops.yaml のパス（ROOT/config or bin/config を自動探索）")
     ap.add_argument("--only", default=None, help="この shopId のみ実行（例: shopA）")
+    ap.add_argument("--jobs", type=int, default=None,
+                    help="同時に実行する店舗数（既定: min(8, 店舗数)）")
+    ap.add_argument("--force", action="store_true",
+                    help="配信済み・クールダウン中で入力が同じでも実行する")
+    ap.add_argument("-v", "--verbose", action="store_true",
+                    help="INFO/DEBUG 行を店舗ログに出力する")
     args = ap.parse_args()
 
+    global VERBOSE
+    VERBOSE = args.verbose
+
     cfg_path = find_config_path(os.path.basename(args.config)) \
         if not os.path.isabs(args.config) else pathlib.Path(args.config)
     cfg = load_yaml(cfg_path)
 
-    targets = cfg["shops"]
+    shops_list = cfg["shops"]
     if args.only:
-        targets = [s for s in targets if s["id"] == args.only]
-        if not targets:
+        by_id = {s.get("id"): s for s in shops_list}
+        try:
+            shops_list = [by_id[args.only]]
+        except KeyError:
             print(f"[ERROR] shop '{args.only}' not found in {cfg_path}")
             sys.exit(1)
 
-    for shop in targets:
+    # スキーマ検証と既定値の適用は起動時に1回だけ
+    # 設定が壊れている店舗は FATAL を残して飛ばし、他の店舗はそのまま実行する（障害分離）
+    targets = []
+    for s in shops_list:
         try:
-            run_shop(shop)
-        except Exception as e:
-            ts = dt.datetime.now().isoformat(timespec="seconds")
-            with open(log_path(shop["id"]), "a", encoding="utf-8") as lg:
-                lg.write(f"\n[{ts}] FATAL {e}\n")
+            targets.append(ShopSpec.from_dict(s))
+        except (ValueError, TypeError, AttributeError) as e:
+            sid = s.get("id") if isinstance(s, dict) else None
+            msg = f"invalid shop config in {cfg_path}: {e}"
+            if sid:
+                _log_write(str(sid), f"\n[{_now_ts()}] FATAL {msg}\n")
+            else:
+                print(f"[ERROR] {msg}")
+
+    jobs = args.jobs if args.jobs is not None else min(8, len(targets))
+    jobs = max(1, jobs)
+
+    # 各店舗のログは1つの run_shop だけが書くので、並列でも行が混ざらない
+    asyncio.run(run_all(targets, jobs, args.force))
 
 if __name__ == "__main__":
     main()
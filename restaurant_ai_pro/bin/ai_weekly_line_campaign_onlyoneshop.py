@@ -13,11 +13,13 @@ AI週報（PDF生成）＋ 顧客向け 自動販促（クーポン/おすすめ
 必要環境変数
 - LINE_CHANNEL_ACCESS_TOKEN（必須）
 - OPENWEATHER_KEY（任意：天気連動を使う場合）
+- WEATHER_CACHE_PATH（任意：天気キャッシュの保存先、既定 .state/wx_cache.json）
+- JP_FONT_PATH（任意：PDF用の日本語フォント。未指定なら既定の候補から探す）
 - MPLBACKEND=Agg（PDF生成時のGUI省略、ランナーが設定）
 """
 
 from __future__ import annotations
-import os, json, time, argparse, datetime as dt
+import os, json, time, pickle, argparse, functools, datetime as dt
 from dataclasses import dataclass
 from typing import Optional, Iterable, List, Tuple
 import re
@@ -27,70 +29,136 @@ import glob
 from typing import Dict, Any
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import random
+from concurrent.futures import ThreadPoolExecutor
 
 # 外部モジュール（あなたのパッケージ）
 from restaurant_ai.advisor import AdviceInput, generate_actionable_advice
 
-# ========= Matplotlib（日本語フォント/Agg） =========
-import matplotlib
-matplotlib.use("Agg")
-from matplotlib import rcParams, font_manager as fm
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
-
-FONT_CANDIDATES = [
-    "/usr/share/fonts/opentype/ipaexfont/ipaexg.ttf",
-    "/usr/share/fonts/opentype/ipaexg.ttf",
-    "/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf",
-    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-    "/mnt/c/Windows/Fonts/meiryo.ttc",
-    "/mnt/c/Windows/Fonts/YuGothR.ttc",
-    "/mnt/c/Windows/Fonts/msgothic.ttc",
-]
-JP_FONT_PATH = next((p for p in FONT_CANDIDATES if os.path.exists(p)), None)
-if JP_FONT_PATH:
-    JP = fm.FontProperties(fname=JP_FONT_PATH)
-    rcParams["font.family"] = JP.get_name()
-else:
-    JP = None
-    rcParams["font.family"] = "DejaVu Sans"
-rcParams["axes.unicode_minus"] = False
-rcParams["pdf.fonttype"] = 42
-rcParams["ps.fonttype"]  = 42
-
 # ========= 定数 =========
 LINE_PUSH_API       = "https://api.line.me/v2/bot/message/push"
 LINE_MULTICAST_API  = "https://api.line.me/v2/bot/message/multicast"
 LINE_BROADCAST_API  = "https://api.line.me/v2/bot/message/broadcast"
 OPENWEATHER_URL     = "https://api.openweathermap.org/data/2.5/weather"
+LINE_CONCURRENCY    = int(os.environ.get("LINE_CONCURRENCY", "8"))  # 同時に投げる LINE API リクエスト数
+
+# ========= HTTP セッション（keep-alive で LINE / OpenWeather の接続を使い回す） =========
+# POST は冪等でないので status でのリトライは GET（天気）のみ。接続エラーは全メソッドで再試行
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+_HTTP.headers.update({"Content-Type": "application/json"})
 
 # ========= ユーティリティ =========
 def ensure_dir(path: str) -> None:
     if path:
         os.makedirs(path, exist_ok=True)
 
+def _clean_uids(seq: Iterable[str]) -> list[str]:
+    """前後空白を除き、空行と重複を落とす（順序は保持）"""
+    seen: set[str] = set()
+    out: list[str] = []
+    for u in seq:
+        s = u.strip() if u else ""
+        if s and s not in seen:
+            seen.add(s)
+            out.append(s)
+    return out
+
 def read_lines(path: Optional[str]) -> list[str]:
+    """recipients ファイルを読む。ここで1回だけ整形・重複除去する"""
     if not path or not os.path.exists(path):
         return []
     with open(path, "r", encoding="utf-8") as f:
-        return [ln.strip() for ln in f if ln.strip()]
+        return _clean_uids(f)
 
 def now_iso() -> str:
     return dt.datetime.now().astimezone().isoformat(timespec="seconds")
 
 # ========= データ読み込み／分析 =========
-def load_daily(csv_path: str) -> pd.DataFrame:
-    df = pd.read_csv(csv_path)
-    if "date" not in df.columns or "sales" not in df.columns:
+# pyarrow があれば CSV パーサに使う（無ければ C エンジン）
+try:
+    import pyarrow  # noqa: F401
+    _CSV_ENGINE = "pyarrow"
+except ImportError:
+    _CSV_ENGINE = "c"
+
+_DAILY_NUM_COLS = ("sales", "guests", "new_customers", "repeat_rate")
+# 週報/advisor が参照する列だけ読む（それ以外の列はパース時に捨てる）
+_DAILY_USECOLS = frozenset(("date", "dow") + _DAILY_NUM_COLS)
+
+_DAILY_DISK_CACHE_MIN = 1 << 20  # daily_csv はこれより大きいときだけディスクキャッシュを使う
+
+def _cached_read_frame(src_path: str, parse) -> pd.DataFrame:
+    """
+    CSV のパース結果を隣に <src>.pkl として保存し、CSV の (mtime_ns, size) が保存時と
+    完全に一致するときだけそちらを読む（cp -p などで古い mtime の CSV に差し替わっても拾える）。
+    キャッシュが読めない/書けない場合は普通にパースするだけ。
+    """
+    cache = src_path + ".pkl"
+    st = os.stat(src_path)
+    key = (st.st_mtime_ns, st.st_size)
+    try:
+        with open(cache, "rb") as f:
+            saved = pickle.load(f)
+        if isinstance(saved, dict) and saved.get("src") == key:
+            return saved["df"]
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        pass  # キャッシュ無し・書きかけ・pandas の版違いなど → パースし直す
+    df = parse(src_path)
+    # menu.csv は複数店舗で共有されていて店舗プロセスが並行に書くので、一時ファイル名に pid を付ける
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump({"src": key, "df": df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return df
+
+def _cached_read_menu(menu_path: str) -> pd.DataFrame:
+    return _cached_read_frame(menu_path, pd.read_csv)
+
+@functools.lru_cache(maxsize=8)
+def _read_daily(csv_path: str, mtime_ns: int, size: int) -> pd.DataFrame:
+    """(path, mtime, size) 単位でパース結果をメモ化する。"""
+    if size > _DAILY_DISK_CACHE_MIN:
+        return _cached_read_frame(csv_path, _parse_daily)
+    return _parse_daily(csv_path)
+
+def _parse_daily(csv_path: str) -> pd.DataFrame:
+    # pyarrow エンジンは callable の usecols を受け付けないので、ヘッダだけ先に読んで列名リストで渡す
+    header = pd.read_csv(csv_path, nrows=0).columns
+    if "date" not in header or "sales" not in header:
         raise ValueError("daily_csv に 'date','sales' 列が必要です。")
+    usecols = [c for c in header if c in _DAILY_USECOLS]
+    try:
+        # 型はパース時に確定させる（数値列 float64 / date は datetime）
+        df = pd.read_csv(csv_path, engine=_CSV_ENGINE, usecols=usecols, parse_dates=["date"],
+                         dtype={c: "float64" for c in _DAILY_NUM_COLS if c in usecols})
+    except ValueError:
+        # 数値列に文字が混じる・date 列が無い等 → 従来どおり読んでから変換
+        df = pd.read_csv(csv_path, usecols=usecols)
+        for c in _DAILY_NUM_COLS:
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors="coerce")
     df["date"] = pd.to_datetime(df["date"]).dt.tz_localize(None)
     if "dow" not in df.columns:
-        df["dow"] = df["date"].dt.dayofweek
-    for c in ["sales", "guests", "new_customers", "repeat_rate"]:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    return df.sort_values("date").reset_index(drop=True)
+        df["dow"] = pd.Categorical(df["date"].dt.dayofweek, categories=range(7), ordered=True)
+    # 日付をソート済み DatetimeIndex にして、期間抽出を二分探索のスライスで行う
+    return df.set_index("date").sort_index()
+
+def load_daily(csv_path: str) -> pd.DataFrame:
+    st = os.stat(csv_path)
+    return _read_daily(csv_path, st.st_mtime_ns, st.st_size).copy()
 
 @dataclass
 class WeeklySummary:
@@ -108,13 +176,15 @@ def analyze_week(daily: pd.DataFrame) -> WeeklySummary:
     if daily.empty:
         today = pd.Timestamp.today().normalize()
         return WeeklySummary(today, today, 0.0, 0.0, None, None, None, None, ["データなし"])
-    end = daily["date"].max().normalize()
+    idx = daily.index
+    end = idx.max().normalize()
     start = end - pd.Timedelta(days=6)
-    this_w = daily[(daily["date"] >= start) & (daily["date"] <= end)].copy()
-    prev_w = daily[(daily["date"] >= start - pd.Timedelta(days=7)) & (daily["date"] < start)].copy()
+    this_w = daily.loc[start:end]
+    # 前週は [start-7d, start) の半開区間
+    prev_w = daily.iloc[idx.searchsorted(start - pd.Timedelta(days=7)):idx.searchsorted(start)]
 
     total_sales   = float(this_w["sales"].sum())
-    avg_day_sales = float(this_w.groupby(this_w["date"].dt.date)["sales"].sum().mean())
+    avg_day_sales = float(this_w["sales"].groupby(this_w.index.normalize()).sum().mean())
 
     total_guests = float(this_w["guests"].sum()) if "guests" in this_w.columns else None
 
@@ -125,7 +195,7 @@ def analyze_week(daily: pd.DataFrame) -> WeeklySummary:
         if len(s):
             rr = float(s.mean())
 
-    dow_sales = this_w.groupby("dow")["sales"].mean() if len(this_w) else pd.Series(dtype=float)
+    dow_sales = this_w["sales"].groupby(this_w.index.dayofweek).mean() if len(this_w) else pd.Series(dtype=float)
     dow_weak  = int(dow_sales.idxmin()) if len(dow_sales) else None
 
     trend_ratio = None
@@ -146,24 +216,71 @@ def analyze_week(daily: pd.DataFrame) -> WeeklySummary:
     return WeeklySummary(start, end, total_sales, avg_day_sales, total_guests, rr, dow_weak, trend_ratio, props)
 
 # ========= PDF生成（内部用） =========
-def _apply_jp(ax):
-    if JP is None:
+# Matplotlib（日本語フォント/Agg）は PDF を作るときだけ読み込む。--only_coupon の実行では import しない
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/ipaexfont/ipaexg.ttf",
+    "/usr/share/fonts/opentype/ipaexg.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/mnt/c/Windows/Fonts/meiryo.ttc",
+    "/mnt/c/Windows/Fonts/YuGothR.ttc",
+    "/mnt/c/Windows/Fonts/msgothic.ttc",
+]
+
+@functools.lru_cache(maxsize=None)
+def _find_jp_font() -> Optional[str]:
+    """日本語フォントのパス。JP_FONT_PATH が指定されていれば候補の走査を省く。"""
+    env_path = os.environ.get("JP_FONT_PATH")
+    if env_path and os.path.exists(env_path):
+        return env_path
+    return next((p for p in FONT_CANDIDATES if os.path.exists(p)), None)
+
+@functools.lru_cache(maxsize=1)
+def _lazy_import_matplotlib():
+    """(pyplot, PdfPages, JP FontProperties or None) を返す。初回のみ import と rcParams 設定を行う。"""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import rcParams, font_manager as fm
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    jp_font_path = _find_jp_font()
+    if jp_font_path:
+        jp = fm.FontProperties(fname=jp_font_path)
+        # フォントマネージャに登録しておけば rcParams の family 名だけで解決できる
+        fm.fontManager.addfont(jp_font_path)
+        rcParams["font.family"] = jp.get_name()
+    else:
+        jp = None
+        rcParams["font.family"] = "DejaVu Sans"
+    rcParams["axes.unicode_minus"] = False
+    rcParams["pdf.fonttype"] = 42
+    rcParams["ps.fonttype"]  = 42
+    # 折れ線は簡略化パスで描画（点数が少ないので見た目は変わらない）
+    rcParams["path.simplify"] = True
+    rcParams["path.simplify_threshold"] = 1.0
+    rcParams["agg.path.chunksize"] = 10000
+    return plt, PdfPages, jp
+
+def _is_cjk(s: str) -> bool:
+    return any(ord(c) > 127 for c in s)
+
+def _apply_jp(ax, jp):
+    # タイトル/軸ラベルは rcParams の font.family で日本語になるので、目盛りだけ上書き
+    # （日付や数値など ASCII だけの目盛りは既定フォントのままでよい）
+    if jp is None:
         return
-    if ax.get_title():
-        ax.set_title(ax.get_title(), fontproperties=JP)
-    if ax.get_xlabel():
-        ax.set_xlabel(ax.get_xlabel(), fontproperties=JP)
-    if ax.get_ylabel():
-        ax.set_ylabel(ax.get_ylabel(), fontproperties=JP)
     for lab in ax.get_xticklabels() + ax.get_yticklabels():
-        lab.set_fontproperties(JP)
+        t = lab.get_text()
+        if t and _is_cjk(t):
+            lab.set_fontproperties(jp)
 
 def build_pdf(summary: WeeklySummary, daily: pd.DataFrame, out_pdf: str) -> None:
+    plt, PdfPages, jp_font = _lazy_import_matplotlib()
     ensure_dir(os.path.dirname(out_pdf))
     with PdfPages(out_pdf) as pdf:
         fig = plt.figure(figsize=(8.27, 11.69))
-        fig.text(0.10, 0.92, "AI週報（自動生成）", fontproperties=JP, fontsize=18, weight="bold")
-        y = 0.86
+        fig.text(0.10, 0.92, "AI週報（自動生成）", fontsize=18, weight="bold")
         lines = [
             f"期間：{summary.start_date.date()}〜{summary.end_date.date()}",
             f"総売上：¥{summary.total_sales:,.0f}",
@@ -180,33 +297,57 @@ def build_pdf(summary: WeeklySummary, daily: pd.DataFrame, out_pdf: str) -> None
             lines.append(f"弱い曜日：{jp}曜日")
         lines.append("— 提案 —")
         lines += [f"・{p}" for p in summary.proposals]
+        # 行送りは従来どおり図の高さの 0.04 ずつ（複数行を 1 つの text にすると行間がフォント依存で詰まる）
+        y = 0.86
         for ln in lines:
-            fig.text(0.10, y, ln, fontproperties=JP, fontsize=12)
+            fig.text(0.10, y, ln, fontsize=12)
             y -= 0.04
 
         ax = fig.add_axes([0.10, 0.10, 0.80, 0.30])
-        last14 = daily[daily["date"] >= summary.end_date - pd.Timedelta(days=13)]
-        ax.plot(last14["date"], last14["sales"], marker="o")
+        last14 = daily.loc[summary.end_date - pd.Timedelta(days=13):]
+        ax.plot(last14.index, last14["sales"], marker="o")
         ax.set_title("直近14日 売上推移")
         ax.set_xlabel("日付")
         ax.set_ylabel("売上（円）")
-        _apply_jp(ax)
+        _apply_jp(ax, jp_font)
         fig.autofmt_xdate()
         pdf.savefig(fig)
         plt.close(fig)
 
 # ========= 天気 =========
+# 天気は数十分単位でしか変わらないので、都市ごとに結果をファイルへ短期キャッシュ
+WEATHER_CACHE_PATH      = os.environ.get("WEATHER_CACHE_PATH", os.path.join(".state", "wx_cache.json"))
+WEATHER_CACHE_TTL       = 600    # 秒：この間は API を呼ばない
+WEATHER_STALE_IF_ERROR  = 3600   # 秒：API 失敗時はこの範囲の古い値で代用
+
 def fetch_weather(city: Optional[str]) -> Optional[str]:
     key = os.environ.get("OPENWEATHER_KEY")
     if not key or not city:
         return None
+
+    cache = load_state(WEATHER_CACHE_PATH)
+    hit = cache.get(city) or {}
+    age = time.time() - float(hit.get("ts", 0))
+    if hit and age < WEATHER_CACHE_TTL:
+        return hit.get("main")
+
     try:
-        r = requests.get(OPENWEATHER_URL, params={"q": city, "appid": key}, timeout=8)
-        if r.status_code != 200:
-            return None
-        return (r.json().get("weather") or [{}])[0].get("main")
+        r = _HTTP.get(OPENWEATHER_URL, params={"q": city, "appid": key}, timeout=8)
+        if r.status_code == 200:
+            main = (r.json().get("weather") or [{}])[0].get("main")
+            cache[city] = {"ts": time.time(), "main": main}
+            try:
+                save_state(WEATHER_CACHE_PATH, cache)
+            except OSError as e:
+                print(f"[WARN] weather cache not saved: {e}")
+            return main
     except Exception:
-        return None
+        pass
+
+    # OpenWeather 障害時はキャンペーンを止めないよう、少し古い値でも使う
+    if hit and age < WEATHER_STALE_IF_ERROR:
+        return hit.get("main")
+    return None
 
 def is_bad_weather(main: Optional[str]) -> bool:
     if not main:
@@ -214,11 +355,17 @@ def is_bad_weather(main: Optional[str]) -> bool:
     return main.lower() in {"rain", "snow", "drizzle", "thunderstorm"}
 
 # ========= LINE 送信 =========
+_LINE_AUTH: Optional[dict] = None
+
 def _line_headers() -> dict:
-    token = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
-    if not token:
-        raise RuntimeError("環境変数 LINE_CHANNEL_ACCESS_TOKEN が未設定です。")
-    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    """Authorization ヘッダのみ返す（Content-Type は _HTTP 側で共通設定）。初回だけ組み立てる"""
+    global _LINE_AUTH
+    if _LINE_AUTH is None:
+        token = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
+        if not token:
+            raise RuntimeError("環境変数 LINE_CHANNEL_ACCESS_TOKEN が未設定です。")
+        _LINE_AUTH = {"Authorization": f"Bearer {token}"}
+    return _LINE_AUTH
 
 def send_broadcast(text: str) -> Tuple[int, int]:
     """return: (ok, fail)"""
@@ -227,38 +374,77 @@ def send_broadcast(text: str) -> Tuple[int, int]:
         return (0, 0)
     headers = _line_headers()
     payload = {"messages": [{"type": "text", "text": text}]}
-    r = requests.post(LINE_BROADCAST_API, headers=headers, json=payload, timeout=10)
+    r = _HTTP.post(LINE_BROADCAST_API, headers=headers, json=payload, timeout=10)
     if r.status_code == 200:
         return (1, 0)
     print(f"[WARN] BROADCAST {r.status_code}: {r.text}")
     return (0, 1)
 
-def send_multicast(uids: Iterable[str], text: str, chunk: int = 500) -> Tuple[int, int]:
+def _post_push(headers: dict, uid: str, messages: list[dict]) -> bool:
+    pr = _HTTP.post(
+        LINE_PUSH_API,
+        headers=headers,
+        json={"to": uid, "messages": messages},
+        timeout=10,
+    )
+    if pr.status_code == 200:
+        return True
+    if pr.status_code == 429 or pr.status_code >= 500:
+        time.sleep(0.2)  # レート制限/一時障害のときだけ少し待つ
+    return False
+
+def _send_chunk(headers: dict,
+                part: list[str],
+                messages: list[dict],
+                retries: int = 3,
+                backoff: float = 0.5) -> Tuple[int, int]:
+    """
+    multicast を1チャンク送信。429/5xx は指数バックオフで再試行し、
+    それでも失敗したらチャンクごと失敗として返す（分割して投げ直すと 429 をかえって増やす）。
+    400（宛先や内容の不備）のときだけ半分に分けて再 multicast（二分割）し、1件まで割れたら push。
+    不正な uid の影響を O(log N) 回の往復に抑えつつ、multicast の通数を維持する。
+    """
+    r = None
+    for attempt in range(retries):
+        r = _HTTP.post(LINE_MULTICAST_API, headers=headers,
+                       json={"to": part, "messages": messages}, timeout=10)
+        if r.status_code == 200:
+            return (len(part), 0)
+        if r.status_code != 429 and r.status_code < 500:
+            break  # 4xx は再試行しても同じ
+        if attempt < retries - 1:
+            time.sleep(backoff * 2 ** attempt)
+    if r.status_code != 400:
+        # 認証エラーや 429/5xx は分割しても直らないのでチャンクごと失敗扱い
+        print(f"[WARN] MULTICAST {r.status_code}: {r.text} (size={len(part)})")
+        return (0, len(part))
+    print(f"[WARN] MULTICAST {r.status_code}: {r.text} (size={len(part)}, split)")
+
+    if len(part) == 1:
+        return (1, 0) if _post_push(headers, part[0], messages) else (0, 1)
+    mid = len(part) // 2
+    ok1, fail1 = _send_chunk(headers, part[:mid], messages, retries, backoff)
+    ok2, fail2 = _send_chunk(headers, part[mid:], messages, retries, backoff)
+    return (ok1 + ok2, fail1 + fail2)
+
+def _multicast_with_fallback(ids: list[str],
+                             messages: list[dict],
+                             chunk: int = 500) -> Tuple[int, int]:
+    """500件ずつのチャンクを LINE_CONCURRENCY 本まで並行に送信する"""
     headers = _line_headers()
+    parts = [ids[i:i+chunk] for i in range(0, len(ids), chunk)]
+    if not parts:
+        return (0, 0)
     ok = fail = 0
-    ids = [u.strip() for u in uids if u and u.strip()]
-    for i in range(0, len(ids), chunk):
-        part = ids[i:i+chunk]
-        payload = {"to": part, "messages": [{"type": "text", "text": text}]}
-        r = requests.post(LINE_MULTICAST_API, headers=headers, json=payload, timeout=10)
-        if r.status_code == 200:
-            ok += len(part)
-        else:
-            print(f"[WARN] MULTICAST {r.status_code}: {r.text} (fallback to push)")
-            for uid in part:
-                pr = requests.post(
-                    LINE_PUSH_API,
-                    headers=headers,
-                    json={"to": uid, "messages": [{"type": "text", "text": text}]},
-                    timeout=10,
-                )
-                if pr.status_code == 200:
-                    ok += 1
-                else:
-                    fail += 1
-                    time.sleep(0.2)
+    with ThreadPoolExecutor(max_workers=max(1, LINE_CONCURRENCY)) as ex:
+        for ok_n, fail_n in ex.map(lambda part: _send_chunk(headers, part, messages), parts):
+            ok += ok_n
+            fail += fail_n
     return (ok, fail)
 
+def send_multicast(uids: Iterable[str], text: str, chunk: int = 500) -> Tuple[int, int]:
+    return _multicast_with_fallback(list(uids), [{"type": "text", "text": text}], chunk)
+
 def send_text_all_modes(text: str,
                         enable_broadcast: bool,
                         recipients: list[str]) -> Tuple[int, int, str]:
@@ -288,59 +474,81 @@ def send_messages_all_modes(messages: list[dict],
     # 1) Broadcast 優先
     if enable_broadcast and os.environ.get("DISABLE_BROADCAST", "0") != "1":
         payload = {"messages": messages}
-        r = requests.post(LINE_BROADCAST_API, headers=headers, json=payload, timeout=10)
+        r = _HTTP.post(LINE_BROADCAST_API, headers=headers, json=payload, timeout=10)
         if r.status_code == 200:
             return (1, 0, "broadcast")
         print(f"[WARN] BROADCAST {r.status_code}: {r.text}")
 
     # 2) recipients があれば multicast → 失敗は push フォールバック
-    ids = [u.strip() for u in recipients if u and u.strip()]
-    if ids:
-        ok = fail = 0
-        for i in range(0, len(ids), 500):
-            part = ids[i:i+500]
-            payload = {"to": part, "messages": messages}
-            r = requests.post(LINE_MULTICAST_API, headers=headers, json=payload, timeout=10)
-            if r.status_code == 200:
-                ok += len(part)
-            else:
-                print(f"[WARN] MULTICAST {r.status_code}: {r.text} (fallback to push)")
-                for uid in part:
-                    pr = requests.post(
-                        LINE_PUSH_API,
-                        headers=headers,
-                        json={"to": uid, "messages": messages},
-                        timeout=10,
-                    )
-                    if pr.status_code == 200:
-                        ok += 1
-                    else:
-                        fail += 1
-                        time.sleep(0.2)
+    if recipients:
+        ok, fail = _multicast_with_fallback(list(recipients), messages)
         return (ok, fail, "multicast/push")
 
     print("[INFO] no recipients and broadcast disabled; send skipped")
     return (0, 0, "none")
 
+def send_campaign(text: str,
+                  flex: Optional[dict],
+                  enable_broadcast: bool,
+                  recipients: list[str]) -> Tuple[int, int, str]:
+    """
+    テキスト + Flex（任意）を 1 回の API 呼び出しの messages 配列にまとめて送る。
+    （LINE は 1 リクエスト 5 メッセージまで。2 回送るより通数・往復とも半分で済む）
+    """
+    messages: list[dict] = [{"type": "text", "text": text}]
+    if flex:
+        messages.append(flex)
+    return send_messages_all_modes(messages, enable_broadcast, recipients)
+
 # ========= 状態（クールダウン & 週次カウンタ） =========
+# orjson があれば使う（無ければ標準 json。どちらも UTF-8 / インデント2 で同じ形式）
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = lambda o: orjson.dumps(o, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    _loads = json.loads
+    _dumps = lambda o: json.dumps(o, ensure_ascii=False, indent=2).encode("utf-8")
+
+# path → 最後に読んだ/書いた内容（同じ内容なら save_state で書き直さない）
+_STATE_SNAPSHOT: Dict[str, bytes] = {}
+
 def load_state(path: str) -> dict:
     if not os.path.exists(path):
         return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            raw = f.read()
+        obj = _loads(raw)
     except Exception:
         return {}
+    _STATE_SNAPSHOT[path] = _dumps(obj)
+    return obj
 
 def save_state(path: str, obj: dict) -> None:
+    data = _dumps(obj)
+    if _STATE_SNAPSHOT.get(path) == data and os.path.exists(path):
+        return
+    # 一時ファイルに書いてから置き換える（書き込み途中で落ちても state が壊れない）。
+    # 天気キャッシュは並行に走る店舗プロセスで共有するので、一時ファイル名に pid を付けて衝突させない
     ensure_dir(os.path.dirname(path))
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
-
-def passed_cooldown(state_path: str, hours: int) -> bool:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _STATE_SNAPSHOT[path] = data
+
+def passed_cooldown(st: dict, hours: int) -> bool:
+    """読み込み済みの state（load_weekly_state の戻り値）で判定する"""
     if hours <= 0:
         return True
-    st = load_state(state_path)
     ts = st.get("last_broadcast_at")
     if not ts:
         return True
@@ -351,15 +559,12 @@ def passed_cooldown(state_path: str, hours: int) -> bool:
     delta = dt.datetime.now().astimezone() - last.astimezone()
     return (delta.total_seconds() >= hours * 3600)
 
-def load_weekly_state(state_path: str) -> dict:
+def load_weekly_state(state_path: str, current_week: int) -> dict:
     """
     週単位の配信回数を管理するための状態を読み込む。
     週が変わっていたらカウンタをリセットして返す。
     """
     st = load_state(state_path)
-    today = pd.Timestamp.today()
-    current_week = today.isocalendar()[1]
-
     saved_week = st.get("week_number")
     if saved_week != current_week:
         st["week_number"] = current_week
@@ -384,6 +589,9 @@ def save_weekly_state(state_path: str,
     save_state(state_path, st)
 
 # ========= キャンペーンモード判定 =========
+_PROFIT_RE = re.compile(r"（粗利[^）]*）")
+_DUMMY_MENU_NAMES = frozenset({"おすすめ", "おすすめメニュー", ""})
+
 def _strip_profit_info(menu_name: str) -> str:
     """
     顧客向け文面では「（粗利◯%）」などの内部情報を削る。
@@ -393,15 +601,39 @@ def _strip_profit_info(menu_name: str) -> str:
         return ""
 
     # 「（粗利...）」みたいな全角カッコ部分を削除
-    cleaned = re.sub(r"（粗利[^）]*）", "", str(menu_name))
-    cleaned = cleaned.strip()
+    cleaned = _PROFIT_RE.sub("", str(menu_name)).strip()
 
     # ダミー名は出さない
-    if cleaned in ("おすすめ", "おすすめメニュー", ""):
+    if cleaned in _DUMMY_MENU_NAMES:
         return ""
 
     return cleaned
 
+_BAD_WEATHER_MAINS = frozenset({"snow", "rain", "drizzle", "thunderstorm"})
+
+# (キーワード, 通常時の理由, 悪天候時の理由 or None) — 上から順に最初に当たったものを使う
+_MENU_REASON_RULES = [
+    # 海鮮系
+    (re.compile("海鮮|刺身|サーモン|マグロ"),
+     "鮮度の高い海鮮の旨みをしっかり味わえる一品です。", None),
+    # カレー・スパイス系
+    (re.compile("カレー|スパイス"),
+     "スパイスの風味をしっかり楽しめる、人気の定番メニューです。",
+     "スパイスの香りで身体があたたまる、寒い日にもぴったりのメニューです。"),
+    # チーズ系
+    (re.compile("チーズ"),
+     "濃厚なチーズのコクを楽しめる、満足感の高い一皿です。", None),
+    # 揚げ物系
+    (re.compile("フライ|からあげ|唐揚げ|天ぷら"),
+     "揚げたての食感がクセになる、おつまみにもおすすめのメニューです。", None),
+    # サラダ・野菜系
+    (re.compile("サラダ|野菜|ベジ"),
+     "野菜をたっぷり使った、さっぱりとお召し上がりいただけるメニューです。", None),
+    # デザート系
+    (re.compile("プリン|ケーキ|パフェ|アイス"),
+     "食後のひと休みにぴったりなデザートメニューです。", None),
+]
+
 def _build_menu_reason(menu_name: str,
                        weather_main: Optional[str] = None) -> str:
     """
@@ -411,40 +643,21 @@ def _build_menu_reason(menu_name: str,
     name = menu_name or ""
     w = (weather_main or "").lower()
 
-    # 海鮮系
-    if "海鮮" in name or "刺身" in name or "サーモン" in name or "マグロ" in name:
-        return "鮮度の高い海鮮の旨みをしっかり味わえる一品です。"
-
-    # カレー・スパイス系
-    if "カレー" in name or "スパイス" in name:
-        if w in {"snow", "rain", "drizzle", "thunderstorm"}:
-            return "スパイスの香りで身体があたたまる、寒い日にもぴったりのメニューです。"
-        else:
-            return "スパイスの風味をしっかり楽しめる、人気の定番メニューです。"
-
-    # チーズ系
-    if "チーズ" in name:
-        return "濃厚なチーズのコクを楽しめる、満足感の高い一皿です。"
-
-    # 揚げ物系
-    if any(k in name for k in ["フライ", "からあげ", "唐揚げ", "天ぷら"]):
-        return "揚げたての食感がクセになる、おつまみにもおすすめのメニューです。"
-
-    # サラダ・野菜系
-    if "サラダ" in name or "野菜" in name or "ベジ" in name:
-        return "野菜をたっぷり使った、さっぱりとお召し上がりいただけるメニューです。"
-
-    # デザート系
-    if any(k in name for k in ["プリン", "ケーキ", "パフェ", "アイス"]):
-        return "食後のひと休みにぴったりなデザートメニューです。"
+    for pattern, reason, bad_weather_reason in _MENU_REASON_RULES:
+        if pattern.search(name):
+            if bad_weather_reason and w in _BAD_WEATHER_MAINS:
+                return bad_weather_reason
+            return reason
 
     # デフォルト
     return "素材の味わいを生かした、スタッフおすすめの一品です。"
 
 def decide_campaign_mode(ws: WeeklySummary,
-                         weather_main: Optional[str]) -> str:
+                         weather_main: Optional[str],
+                         today_dow: int) -> str:
     """
     売上トレンド × 天気 × 弱曜日 からキャンペーンモードを決定
+    today_dow: 今日の曜日（0=Mon ... 6=Sun）
     return: "recovery" | "boost" | "brand"
     """
     bad_weather = is_bad_weather(weather_main)
@@ -454,7 +667,7 @@ def decide_campaign_mode(ws: WeeklySummary,
     if trend is None:
         if bad_weather:
             mode = "recovery"
-        elif ws.dow_weak is not None and pd.Timestamp.today().dayofweek == ws.dow_weak:
+        elif ws.dow_weak is not None and today_dow == ws.dow_weak:
             mode = "boost"
     else:
         if trend < 0.9:
@@ -473,13 +686,17 @@ def decide_campaign_mode(ws: WeeklySummary,
 # ========= LINE文面スタイル / 絵文字設定 =========
 from typing import Dict, Any
 
-EMOJI_DICT: Dict[str, list[str]] = {
-    "headline": ["📣", "📢", "📌"],
-    "value": ["🉐", "🔥", "✨"],
-    "food": ["🍺", "🍛", "🍖", "🍽️"],
-    "notice": ["⚠️"],
-    "closing": ["🙇‍♂️", "🙏", "😊"],
+EMOJI_DICT: Dict[str, Tuple[str, ...]] = {
+    "headline": ("📣", "📢", "📌"),
+    "value": ("🉐", "🔥", "✨"),
+    "food": ("🍺", "🍛", "🍖", "🍽️"),
+    "notice": ("⚠️",),
+    "closing": ("🙇‍♂️", "🙏", "😊"),
 }
+_EMOJI_LEN: Dict[str, int] = {k: len(v) for k, v in EMOJI_DICT.items()}
+
+# 文面用の乱数（モジュール random のグローバル状態とは分けておく）
+_RAND = random.Random()
 
 STYLE_CONFIG: Dict[str, Dict[str, Any]] = {
     # ハイテンション系（居酒屋・焼肉など）
@@ -506,12 +723,12 @@ STYLE_CONFIG: Dict[str, Dict[str, Any]] = {
 
 def _pick_emoji(category: str, count: int = 1) -> str:
     """カテゴリ別絵文字のランダム取得"""
-    items = EMOJI_DICT.get(category) or []
-    if not items:
+    n = _EMOJI_LEN.get(category, 0)
+    if not n:
         return ""
     if count <= 1:
-        return random.choice(items)
-    return "".join(random.sample(items, k=min(count, len(items))))
+        return EMOJI_DICT[category][_RAND.randrange(n)]
+    return "".join(_RAND.sample(EMOJI_DICT[category], k=min(count, n)))
 
 def build_reserve_flex(image_url: str, reserve_url: str) -> dict:
     """画像タップで予約ページに飛ばす Flex メッセージ"""
@@ -537,6 +754,33 @@ def build_reserve_flex(image_url: str, reserve_url: str) -> dict:
 
 
 # ========= AIメッセージ生成（顧客向け） =========
+def _format_menu_line(name_clean: str, row: Optional[dict], weather_main: Optional[str]) -> str:
+    """おすすめ1品分（品名・価格の行 + 特徴/理由の行）を組み立てる"""
+    feature = ""
+    note = ""
+    price_str = ""
+    if row is not None:
+        feature = str(row.get("item_feature", "")).strip()
+        note = str(row.get("yield_note", "")).strip()
+        price_val = row.get("price", "")
+        try:
+            if price_val != "":
+                price_str = f"{int(price_val)}円"
+        except Exception:
+            price_str = f"{price_val}円" if price_val not in (None, "") else ""
+
+    title_line = f"・{name_clean}"
+    if price_str:
+        title_line += f"（{price_str}）"
+
+    info_parts = [p for p in [feature, note] if p]
+    if info_parts:
+        info_text = "｜".join(info_parts)
+    else:
+        info_text = _build_menu_reason(name_clean, weather_main)
+
+    return f"{title_line}\n　{info_text}"
+
 def build_ai_campaign_message(ws: WeeklySummary,
                               ad,
                               weather_main: Optional[str],
@@ -580,84 +824,26 @@ def build_ai_campaign_message(ws: WeeklySummary,
             head_sub = "本日の状況に合わせて、AIがおすすめメニューをご案内します。"
 
     # ===== おすすめメニュー生成 =====
-    menu_lines: List[str] = []
-
-    def _lookup_menu_row(name_clean: str):
-        if menu_df is None or "menu" not in menu_df.columns:
-            return None
-        hits = menu_df[menu_df["menu"].astype(str) == str(name_clean)]
-        if hits.empty:
-            return None
-        return hits.iloc[0]
+    # menu.csv はメニュー名 → 行(dict) の索引を1回だけ作る（同名は先頭行を優先）
+    has_menu = menu_df is not None and "menu" in menu_df.columns
+    menu_index: Dict[str, dict] = {}
+    if has_menu:
+        for r in menu_df.to_dict("records"):
+            menu_index.setdefault(str(r["menu"]).strip(), r)
 
     # 1. advisor からの候補を優先
-    raw_items = getattr(ad, "menu_suggestions", None) or []
-    raw_items = list(raw_items)[:3]
-
-    for m in raw_items:
-        name_clean = _strip_profit_info(str(m))
-        if not name_clean:
-            continue
-
-        row = _lookup_menu_row(name_clean)
-        feature = ""
-        note = ""
-        price_str = ""
-
-        if row is not None:
-            feature = str(row.get("item_feature", "")).strip()
-            note = str(row.get("yield_note", "")).strip()
-            price_val = row.get("price", "")
-            try:
-                if price_val != "":
-                    price_str = f"{int(price_val)}円"
-            except Exception:
-                price_str = f"{price_val}円" if price_val not in (None, "") else ""
-        else:
-            price_str = ""
-            feature = ""
-            note = ""
-
-        title_line = f"・{name_clean}"
-        if price_str:
-            title_line += f"（{price_str}）"
-
-        info_parts = [p for p in [feature, note] if p]
-        if info_parts:
-            info_text = "｜".join(info_parts)
-        else:
-            info_text = _build_menu_reason(name_clean, weather_main)
-
-        menu_lines.append(f"{title_line}\n　{info_text}")
+    raw_items = list(getattr(ad, "menu_suggestions", None) or [])[:3]
+    names = [n for n in (_strip_profit_info(str(m)) for m in raw_items) if n]
+    candidates = [(n, menu_index.get(n)) for n in names]
 
     # 2. advisor が何も返さなかった場合 → menu.csv 先頭から3品
-    if not menu_lines and menu_df is not None and "menu" in menu_df.columns:
-        for _, row in menu_df.head(3).iterrows():
-            name_clean = str(row.get("menu", "")).strip()
-            if not name_clean:
-                continue
-
-            feature = str(row.get("item_feature", "")).strip()
-            note = str(row.get("yield_note", "")).strip()
-            price_val = row.get("price", "")
-            price_str = ""
-            try:
-                if price_val != "":
-                    price_str = f"{int(price_val)}円"
-            except Exception:
-                price_str = f"{price_val}円" if price_val not in (None, "") else ""
-
-            title_line = f"・{name_clean}"
-            if price_str:
-                title_line += f"（{price_str}）"
-
-            info_parts = [p for p in [feature, note] if p]
-            if info_parts:
-                info_text = "｜".join(info_parts)
-            else:
-                info_text = _build_menu_reason(name_clean, weather_main)
+    if not candidates and has_menu:
+        for r in menu_df.head(3).to_dict("records"):
+            name_clean = str(r.get("menu", "")).strip()
+            if name_clean:
+                candidates.append((name_clean, r))
 
-            menu_lines.append(f"{title_line}\n　{info_text}")
+    menu_lines = [_format_menu_line(n, r, weather_main) for n, r in candidates]
 
     # 3. それでもなければ最後の保険メッセージ
     if menu_lines:
@@ -688,17 +874,10 @@ def build_ai_campaign_message(ws: WeeklySummary,
     closing_emoji = _pick_emoji("closing")
     closing_line = f"本日もご来店を心よりお待ちしております{closing_emoji}"
 
-    blocks = [
-        head_title,
-        head_sub,
-        "",
-        menu_block,
-        "",
-        guide_block,
-    ]
+    blocks = [head_title, head_sub, "", menu_block, "", guide_block]
     if weather_comment:
-        blocks += ["", weather_comment]
-    blocks += ["", closing_line]
+        blocks.extend(("", weather_comment))
+    blocks.extend(("", closing_line))
 
     # ===== フッター（お問い合わせ・予約導線） =====
     shop_tel = os.environ.get("SHOP_TEL")
@@ -720,10 +899,9 @@ def build_ai_campaign_message(ws: WeeklySummary,
         footer_lines.append(f"🕒 営業時間：{shop_hours}")
 
     if footer_lines:
-        blocks += ["", "\n".join(footer_lines)]
+        blocks.extend(("", "\n".join(footer_lines)))
 
     return "\n".join(blocks)
-    return msg
 
 # ========= AIメッセージ生成（店長/オーナー向け） =========
 def build_owner_campaign_message(ws: WeeklySummary,
@@ -876,10 +1054,14 @@ def main():
     else:
         menu_path = os.path.join(os.path.dirname(args.daily_csv), "menu.csv")
 
-    menu_df = pd.read_csv(menu_path) if os.path.exists(menu_path) else None
+    menu_df = _cached_read_menu(menu_path) if os.path.exists(menu_path) else None
 
     weather_main = fetch_weather(args.city) if args.city else None
 
+    # 日付は実行中に1回だけ取って各判定に渡す
+    today = dt.date.today()
+    weekday = today.weekday()  # 0=Mon ... 6=Sun
+
     kpis = {
         "trend_ratio": ws.trend_ratio,
         "repeat_rate_avg": ws.repeat_rate_avg,
@@ -890,8 +1072,8 @@ def main():
     inp = AdviceInput(
         city=args.city,
         weather_main=weather_main,
-        weekday=pd.Timestamp.today().dayofweek,
-        month=pd.Timestamp.today().month,
+        weekday=weekday,
+        month=today.month,
         location_type=os.environ.get("SHOP_LOCATION", "residential"),
         station_distance_min=int(os.environ.get("SHOP_STATION_MIN", "8")),
         daily_df=daily,
@@ -900,23 +1082,26 @@ def main():
     )
     ad = generate_actionable_advice(inp)
 
-    # === PDFは常に生成（内部成果物） ===
-    pdf_path = os.path.join(args.outdir, "weekly_report.pdf")
-    build_pdf(ws, daily, pdf_path)
-
-    # === 週報テキスト（オーナー向けなど） ===
-    headline = (
-        f"📊 AI週報\n期間：{ws.start_date.date()}〜{ws.end_date.date()}\n"
-        f"総売上：¥{ws.total_sales:,.0f}\n日平均：¥{ws.avg_day_sales:,.0f}\n"
-    )
-    if ws.trend_ratio is not None:
-        headline += f"前週比：{ws.trend_ratio*100:.1f}%\n"
-    headline += "\n— 提案 —\n" + "\n".join([f"・{p}" for p in ws.proposals])
+    # === PDF（内部成果物）。顧客向けクーポン専用の実行では使わないので作らない ===
+    if not args.only_coupon:
+        pdf_path = os.path.join(args.outdir, "weekly_report.pdf")
+        build_pdf(ws, daily, pdf_path)
 
     recipients = read_lines(args.recipients)
 
+    # 顧客向けモードは only_coupon / no_weekly_message いずれかで有効化する想定
+    customer_mode = args.only_coupon or args.no_weekly_message
+
     # === 週報テキスト送信（オーナー/店長向けのみ） ===
-    if not (args.only_coupon or args.no_weekly_message):
+    if not customer_mode:
+        headline = (
+            f"📊 AI週報\n期間：{ws.start_date.date()}〜{ws.end_date.date()}\n"
+            f"総売上：¥{ws.total_sales:,.0f}\n日平均：¥{ws.avg_day_sales:,.0f}\n"
+        )
+        if ws.trend_ratio is not None:
+            headline += f"前週比：{ws.trend_ratio*100:.1f}%\n"
+        headline += "\n— 提案 —\n" + "\n".join([f"・{p}" for p in ws.proposals])
+
         print("[INFO] sending weekly headline to owner/manager...")
         if args.dry_run:
             print("[DRY] WEEKLY:", headline)
@@ -926,48 +1111,46 @@ def main():
             print(f"[SUMMARY] weekly(owner): ok={ok} fail={fail} mode={mode}")
 
     # === 顧客向けキャンペーン配信（週1定期 + extra 週1まで） ===
-    # 顧客向けモードは only_coupon / no_weekly_message いずれかで有効化する想定
-    if not (args.only_coupon or args.no_weekly_message):
+    # 顧客向けでなければ state の読み込みや条件判定は不要なのでここで抜ける
+    if not customer_mode:
         print("[INFO] customer campaign mode is off (only_coupon/no_weekly_message not set).")
         return
 
     state_path = os.path.join(args.state_dir, "broadcast.json")
-    st = load_weekly_state(state_path)
+    st = load_weekly_state(state_path, today.isocalendar()[1])
 
     # 時間インターバルによるクールダウン
-    if not passed_cooldown(state_path, args.cooldown_hours):
+    if not passed_cooldown(st, args.cooldown_hours):
         print(f"[INFO] cooldown active ({args.cooldown_hours}h). skip campaign.")
         return
 
     regular_sent = st.get("regular_sent_count", 0)
     extra_sent   = st.get("extra_sent_count", 0)
 
-    today = pd.Timestamp.today()
-    weekday = today.dayofweek  # 0=Mon ... 6=Sun
-
     # 週末定期配信（金曜18時にバッチが走る前提）
     is_weekend_regular = (weekday == 4)  # 金曜
 
-    # 悪天候 or 弱曜日 or 売上トレンド悪化
-    weak_today   = (ws.dow_weak is not None and weekday == ws.dow_weak)
-    bad_weather  = is_bad_weather(weather_main)
-    bad_sales    = (ws.trend_ratio is not None and ws.trend_ratio < args.threshold)
-
-    # extraの発火条件
-    is_extra_condition = (bad_weather or weak_today or bad_sales)
-    
-    #デバック用
-    print(
-    "[DEBUG] weekday=", weekday,
-    "dow_weak=", ws.dow_weak,
-    "trend_ratio=", ws.trend_ratio,
-    "threshold=", args.threshold,
-    "bad_sales=", bad_sales,
-    "bad_weather=", bad_weather,
-    "weak_today=", weak_today,
-    "regular_sent=", regular_sent,
-    "extra_sent=", extra_sent,
- )
+    # extra の発火条件：悪天候 or 弱曜日 or 売上トレンド悪化
+    def _extra_conditions():
+        weak_today  = (ws.dow_weak is not None and weekday == ws.dow_weak)
+        bad_weather = is_bad_weather(weather_main)
+        bad_sales   = (ws.trend_ratio is not None and ws.trend_ratio < args.threshold)
+        return weak_today, bad_weather, bad_sales
+
+    # デバッグ用（DEBUG_CAMPAIGN=1 のときだけ判定材料を出す）
+    if os.environ.get("DEBUG_CAMPAIGN"):
+        weak_today, bad_weather, bad_sales = _extra_conditions()
+        print(
+            "[DEBUG] weekday=", weekday,
+            "dow_weak=", ws.dow_weak,
+            "trend_ratio=", ws.trend_ratio,
+            "threshold=", args.threshold,
+            "bad_sales=", bad_sales,
+            "bad_weather=", bad_weather,
+            "weak_today=", weak_today,
+            "regular_sent=", regular_sent,
+            "extra_sent=", extra_sent,
+        )
 
     # 週最大 2通まで（regular 1, extra 1）
     campaign_type: Optional[str] = None
@@ -975,8 +1158,8 @@ def main():
     # 1. 定期（regular）優先
     if is_weekend_regular and regular_sent < 1:
         campaign_type = "regular"
-    # 2. 臨時（extra） 上限チェック
-    elif is_extra_condition and extra_sent < 1 and (regular_sent + extra_sent) < 2:
+    # 2. 臨時（extra） 上限チェック → 枠が残っているときだけ条件を評価
+    elif extra_sent < 1 and (regular_sent + extra_sent) < 2 and any(_extra_conditions()):
         campaign_type = "extra"
 
     if campaign_type is None:
@@ -984,7 +1167,7 @@ def main():
         return
 
     # === 実際のメッセージ生成 & 送信 ===
-    campaign_mode = decide_campaign_mode(ws, weather_main)
+    campaign_mode = decide_campaign_mode(ws, weather_main, weekday)
 
     # 顧客向け（数字なし）
     ai_message = build_ai_campaign_message(
@@ -1022,14 +1205,9 @@ def main():
         print(f"[DEBUG] reserve_img={reserve_img}")
         print(f"[DEBUG] reserve_url={reserve_url}")
 
-        # ① まずテキスト
-        messages = [{"type": "text", "text": ai_message}]
-
-        # ② 画像URLと予約URLが両方あるときだけ、Flex画像を追加
-        if reserve_img and reserve_url:
-            messages.append(build_reserve_flex(reserve_img, reserve_url))
-
-        ok, fail, mode = send_messages_all_modes(messages, args.enable_broadcast, recipients)
+        # テキスト + （画像URLと予約URLが両方あるときだけ）Flex画像を 1 リクエストで送る
+        flex = build_reserve_flex(reserve_img, reserve_url) if (reserve_img and reserve_url) else None
+        ok, fail, mode = send_campaign(ai_message, flex, args.enable_broadcast, recipients)
         print(f"[SUMMARY] campaign({campaign_type}): ok={ok} fail={fail} mode={mode}")
 
 
@@ -16,9 +16,12 @@
 
 import sys
 import os
+import numpy as np
 import pandas as pd
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 # -------------------------
 # 設定値（あとで調整しやすいようにここに集約）
@@ -32,9 +35,29 @@ PEAK_TIME_RANGE = (17, 24)  # 17時〜24時を「夜ピーク」とみなす
 SCORE_PRIMARY = 8   # これ以上は「第一候補」
 SCORE_HOLD = 4      # これ以上は「保留」、未満は「除外」
 
+# 判定に使う列（読み込み時は文字列として扱い、型推論を省く）
+USED_COLS = ["飲食経験年数", "勤務可能曜日", "勤務可能時間帯", "長期希望", "通勤手段", "希望月間シフト数", "希望店舗"]
+
+# pyarrow があれば CSV パーサに使う（無ければ C エンジン）
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
 # 長期とみなす月数の目安（今回は長期フラグがあれば加点する前提で使わない）
 LONG_TERM_KEYWORDS = ["長期", "半年以上", "1年以上"]
 
+# よく使う正規表現はモジュール読み込み時に1回だけコンパイル
+_EXP_RE = re.compile(r"(\d+(?:\.\d+)?)")                               # "2年", "1.5年" など
+_HOURS_RE = re.compile(r"(\d{1,2})[:：]?\d{0,2}\s*[-〜]\s*(\d{1,2})")   # "18:00-23:00" など
+_DAY_COUNT_RE = re.compile(r"[^,]*[^\s,][^,]*")                          # 空でない曜日要素
+
+@lru_cache(maxsize=None)
+def _keywords_re(keywords: tuple) -> "re.Pattern":
+    """キーワード群をまとめた 1 本の正規表現（OR）"""
+    return re.compile("|".join(map(re.escape, keywords)))
+
 # -------------------------
 # ユーティリティ関数
 # -------------------------
@@ -47,7 +70,7 @@ def parse_experience_years(raw: str) -> float:
     if "未経験" in text:
         return 0.0
     # 数字だけ拾う（例: "2年", "1.5年"など）
-    m = re.search(r"(\d+(\.\d+)?)", text)
+    m = _EXP_RE.search(text)
     if m:
         return float(m.group(1))
     return 0.0
@@ -55,8 +78,10 @@ def parse_experience_years(raw: str) -> float:
 def contains_any(text: str, keywords) -> bool:
     if pd.isna(text):
         return False
-    t = str(text)
-    return any(k in t for k in keywords)
+    keywords = tuple(keywords)
+    if not keywords:
+        return False
+    return _keywords_re(keywords).search(str(text)) is not None
 
 def parse_available_days(raw: str):
     """勤務可能曜日の文字列から曜日リストを抽出（例: '月,火,金' → ['月','火','金']）"""
@@ -81,7 +106,7 @@ def parse_available_hours(raw: str):
     text = str(raw)
 
     # 明示的な時間帯 "18:00-23:00" 等
-    m = re.search(r"(\d{1,2})[:：]?\d{0,2}\s*[-〜]\s*(\d{1,2})", text)
+    m = _HOURS_RE.search(text)
     if m:
         start = int(m.group(1))
         end = int(m.group(2))
@@ -106,123 +131,109 @@ def hours_overlap(range1, range2):
     return not (e1 <= s2 or e2 <= s1)
 
 # -------------------------
-# 応募者1人分のタグ付け＆スコアリング
+# 全応募者のタグ付け＆スコアリング（列演算でまとめて計算）
 # -------------------------
 
-def evaluate_applicant(row: pd.Series):
-    tags = []
-    score = 0
+def _text_col(df: pd.DataFrame, col: str) -> pd.Series:
+    """列を文字列 Series で返す（欠損・列なしは空文字）"""
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    return df[col].where(df[col].notna(), "").astype(str)
 
-    # 基本情報取得
-    exp_years = parse_experience_years(row.get("飲食経験年数", ""))
-    days = parse_available_days(row.get("勤務可能曜日", ""))
-    hours = parse_available_hours(row.get("勤務可能時間帯", ""))
-    long_term_raw = str(row.get("長期希望", "")).strip()
-    commute_raw = str(row.get("通勤手段", "")).strip()
-    desired_shifts_raw = str(row.get("希望月間シフト数", "")).strip()
+def _contains_any_col(s: pd.Series, keywords) -> pd.Series:
+    return s.str.contains(_keywords_re(tuple(keywords)), regex=True)
+
+def _vectorized_evaluate(df: pd.DataFrame):
+    """
+    evaluate_applicant の判定ルールを全行まとめて適用する。
+    戻り: (AIタグ, AIスコア, AIステータス) の Series 3本
+    """
+    idx = df.index
 
     # === 経験年数 ===
-    if exp_years == 0:
-        tags.append("未経験")
-        score += 1  # 未経験でもOKだが、即戦力ではない前提
-    elif exp_years < 1:
-        tags.append("経験1年未満")
-        score += 2
-    elif exp_years < 3:
-        tags.append("経験1〜3年")
-        score += 3
-    else:
-        tags.append("経験3年以上")
-        score += 4  # ベテラン枠
-
-    # === 勤務可能曜日 ===
-    if any(d in days for d in PEAK_DAYS):
-        tags.append("週末出勤可")
-        score += 3
-    if contains_any("".join(days), ["日"]):
-        tags.append("日曜出勤可")
-        score += 1
-    if len(days) >= 4:
-        tags.append("週4日以上可")
-        score += 2
-    elif len(days) >= 2:
-        tags.append("週2〜3日可")
-        score += 1
-    else:
-        tags.append("週1日程度")
-        score -= 1
-
-    # === 勤務時間帯 ===
-    if hours_overlap(hours, PEAK_TIME_RANGE):
-        tags.append("夜ピーク対応可")
-        score += 3
-    elif hours:
-        tags.append("時間帯限定")
-        score += 0  # 加点なし・減点なし
-    else:
-        tags.append("時間帯不明")
-        score -= 1
+    exp_raw = _text_col(df, "飲食経験年数")
+    exp_years = exp_raw.str.extract(_EXP_RE, expand=False).astype(float).fillna(0.0)
+    exp_years = exp_years.mask(exp_raw.str.contains("未経験", regex=False), 0.0)
+    exp_conds = [exp_years == 0, exp_years < 1, exp_years < 3]
+    score = pd.Series(np.select(exp_conds, [1, 2, 3], default=4), index=idx)
+    tags = pd.Series(np.select(exp_conds, ["未経験", "経験1年未満", "経験1〜3年"], default="経験3年以上"),
+                     index=idx, dtype=object)
+
+    def add(mask, tag, pts):
+        nonlocal score, tags
+        score = score + np.where(mask, pts, 0)
+        tags = tags + np.where(mask, "|" + tag, "")
+
+    # === 勤務可能曜日 ===（"曜日" を除き、カンマ区切りで空でない要素を曜日とみなす）
+    days = _text_col(df, "勤務可能曜日").str.replace("曜日", "", regex=False).str.replace("，", ",", regex=False)
+    n_days = days.str.count(_DAY_COUNT_RE)
+    peak = np.zeros(len(df), dtype=bool)
+    for d in PEAK_DAYS:
+        peak |= days.str.contains(r"(?:^|,)\s*" + re.escape(d) + r"\s*(?:,|$)", regex=True).to_numpy()
+    add(peak, "週末出勤可", 3)
+    add(days.str.contains("日", regex=False), "日曜出勤可", 1)
+    add(n_days >= 4, "週4日以上可", 2)
+    add((n_days >= 2) & (n_days < 4), "週2〜3日可", 1)
+    add(n_days < 2, "週1日程度", -1)
+
+    # === 勤務時間帯 ===（明示的な時間帯 → キーワードの順で判定）
+    hours_raw = _text_col(df, "勤務可能時間帯")
+    m = hours_raw.str.extract(_HOURS_RE)
+    has_range = m[0].notna().to_numpy()
+    kw_conds = [
+        has_range,
+        hours_raw.str.contains("ランチ", regex=False).to_numpy(),
+        _contains_any_col(hours_raw, ["ディナー", "夜"]).to_numpy(),
+        _contains_any_col(hours_raw, ["オール", "終電"]).to_numpy(),
+    ]
+    start = np.select(kw_conds, [m[0].astype(float).to_numpy(), 10, 17, 0], default=np.nan)
+    end = np.select(kw_conds, [m[1].astype(float).to_numpy(), 15, 23, 24], default=np.nan)
+    has_hours = ~np.isnan(start)
+    overlap = has_hours & ~((end <= PEAK_TIME_RANGE[0]) | (PEAK_TIME_RANGE[1] <= start))
+    add(overlap, "夜ピーク対応可", 3)
+    add(has_hours & ~overlap, "時間帯限定", 0)
+    add(~has_hours, "時間帯不明", -1)
 
     # === 長期希望 ===
-    if contains_any(long_term_raw, ["はい", "希望する", "長期"]):
-        tags.append("長期希望")
-        score += 2
-    elif contains_any(long_term_raw, ["短期", "3ヶ月", "期間限定"]):
-        tags.append("短期希望")
-        score -= 1
+    long_term = _text_col(df, "長期希望")
+    lt_long = _contains_any_col(long_term, ["はい", "希望する", "長期"])
+    add(lt_long, "長期希望", 2)
+    add(~lt_long & _contains_any_col(long_term, ["短期", "3ヶ月", "期間限定"]), "短期希望", -1)
 
     # === 通勤手段 ===
-    if contains_any(commute_raw, ["徒歩", "自転車"]):
-        tags.append("近隣在住")
-        score += 2
-    elif contains_any(commute_raw, ["電車", "バス", "車"]):
-        tags.append("遠方通勤")
-        score += 0
+    commute = _text_col(df, "通勤手段")
+    near = _contains_any_col(commute, ["徒歩", "自転車"])
+    add(near, "近隣在住", 2)
+    add(~near & _contains_any_col(commute, ["電車", "バス", "車"]), "遠方通勤", 0)
 
     # === 希望シフト数（ざっくり） ===
-    if contains_any(desired_shifts_raw, ["週4", "週5", "フル", "レギュラー"]):
-        tags.append("高稼働希望")
-        score += 2
-    elif contains_any(desired_shifts_raw, ["週2", "週3"]):
-        tags.append("中稼働希望")
-        score += 1
-    elif contains_any(desired_shifts_raw, ["週1", "たまに"]):
-        tags.append("低稼働希望")
-        score -= 1
-
-    # 将来のために必要ならここに追加条件をどんどん足せる
+    shifts = _text_col(df, "希望月間シフト数")
+    high = _contains_any_col(shifts, ["週4", "週5", "フル", "レギュラー"])
+    mid = ~high & _contains_any_col(shifts, ["週2", "週3"])
+    add(high, "高稼働希望", 2)
+    add(mid, "中稼働希望", 1)
+    add(~high & ~mid & _contains_any_col(shifts, ["週1", "たまに"]), "低稼働希望", -1)
 
     # === 採用ステータス判定 ===
-    if score >= SCORE_PRIMARY:
-        status = "第一候補"
-    elif score >= SCORE_HOLD:
-        status = "保留"
-    else:
-        status = "除外"
+    status = pd.Series(np.select([score >= SCORE_PRIMARY, score >= SCORE_HOLD], ["第一候補", "保留"], default="除外"),
+                       index=idx, dtype=object)
+    return tags, score.astype(int), status
 
-    return "|".join(tags), score, status
+def evaluate_applicant(row: pd.Series):
+    """応募者1人分のタグ付け＆スコアリング（戻り: タグ文字列, スコア, ステータス）"""
+    tags, score, status = _vectorized_evaluate(row.to_frame().T)
+    return tags.iloc[0], int(score.iloc[0]), status.iloc[0]
 
 # -------------------------
 # メイン処理
 # -------------------------
 
 def classify_applicants(input_csv: str):
-    df = pd.read_csv(input_csv)
-
-    # 結果格納用リスト
-    tag_list = []
-    score_list = []
-    status_list = []
-
-    for _, row in df.iterrows():
-        tags, score, status = evaluate_applicant(row)
-        tag_list.append(tags)
-        score_list.append(score)
-        status_list.append(status)
+    # 出力CSVには応募者の全列を残すので usecols では絞らない。判定列だけ str 指定
+    header = pd.read_csv(input_csv, nrows=0).columns
+    df = pd.read_csv(input_csv, engine=CSV_ENGINE, dtype={c: str for c in USED_COLS if c in header})
 
-    df["AIタグ"] = tag_list
-    df["AIスコア"] = score_list
-    df["AIステータス"] = status_list
+    df["AIタグ"], df["AIスコア"], df["AIステータス"] = _vectorized_evaluate(df)
 
     # 全体ファイル出力
     base_name = os.path.splitext(os.path.basename(input_csv))[0]
@@ -232,11 +243,17 @@ def classify_applicants(input_csv: str):
 
     # 店舗別に分割（希望店舗列がある前提）
     if "希望店舗" in df.columns:
+        tasks = []
         for shop, sub in df.groupby("希望店舗"):
             # 第一候補＋保留だけを出したい場合
-            sub_filtered = sub[sub["AIステータス"].isin(["第一候補", "保留"])].copy()
-            out_shop = f"classified_by_shop_{shop}.csv"
-            sub_filtered.to_csv(out_shop, index=False)
+            sub_filtered = sub[sub["AIステータス"].isin(["第一候補", "保留"])]
+            tasks.append((f"classified_by_shop_{shop}.csv", sub_filtered))
+
+        # 店舗ごとの書き出しは互いに独立なので並列に行う
+        if tasks:
+            with ThreadPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1)) as ex:
+                list(ex.map(lambda t: t[1].to_csv(t[0], index=False), tasks))
+        for out_shop, sub_filtered in tasks:
             print(f"[INFO] 店舗別リストを出力しました: {out_shop}（{len(sub_filtered)}件）")
     else:
         print("[WARN] '希望店舗' 列がないため、店舗別出力はスキップしました。")
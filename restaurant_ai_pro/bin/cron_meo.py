@@ -3,9 +3,15 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 import yaml
 
+try:  # libyaml があれば C 実装のパーサを使う
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 sys.path.append(str(PROJECT_ROOT))
 
@@ -14,22 +20,47 @@ from meo.runner import run_meo_for_shop
 CONFIG_PATH = PROJECT_ROOT / "config" / "shops.yaml"
 
 
+# (path, mtime_ns) → MEO 対象店舗。shops.yaml が変わらない限り再パースしない
+_SHOPS_CACHE = {}
+
+
 def load_shops():
+    key = (str(CONFIG_PATH), CONFIG_PATH.stat().st_mtime_ns)
+    if key in _SHOPS_CACHE:
+        return _SHOPS_CACHE[key]
     with CONFIG_PATH.open("r", encoding="utf-8") as f:
-        raw = yaml.safe_load(f) or {}
+        raw = yaml.load(f, Loader=_YamlLoader) or {}
     shops = []
     for item in raw.get("shops", []):
         # place_id & location_id がある店舗だけ MEO 対象
         if item.get("place_id") and item.get("location_id"):
             shops.append(item)
+    _SHOPS_CACHE.clear()
+    _SHOPS_CACHE[key] = shops
     return shops
 
 
+MAX_WORKERS = 8
+
+
+def _run_one(shop):
+    print(f"=== MEO RUN: {shop['id']} ({shop.get('name', '')}) ===")
+    run_meo_for_shop(shop)
+
+
 def main():
     shops = load_shops()
-    for shop in shops:
-        print(f"=== MEO RUN: {shop['id']} ({shop.get('name', '')}) ===")
-        run_meo_for_shop(shop)
+    if not shops:
+        return
+    # 店舗ごとの処理はほぼ Google API 待ちなので、スレッドで並べて待ち時間を重ねる
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(shops))) as ex:
+        futs = {ex.submit(_run_one, s): s for s in shops}
+        for f in as_completed(futs):
+            shop = futs[f]
+            try:
+                f.result()
+            except Exception as e:
+                print(f"[ERROR] {shop['id']} {e}")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from dataclasses import dataclass
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, List
+from typing import Callable, Iterator, Optional, Dict, List, Tuple
+import asyncio
+import functools
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import random
+import string
 import sys
-import requests
+import threading
+import uuid
+import httpx
 import yaml
 from dotenv import dotenv_values
 import urllib.parse
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
+
+try:  # libyaml があれば C 実装のパーサを使う
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 # =========================================================
 # REV / ENV識別
@@ -35,6 +50,27 @@ CONFIG_DIR = PROJECT_ROOT / "config"
 SHOPS_YAML = CONFIG_DIR / "shops.yaml"
 
 LINE_PUSH_ENDPOINT = "https://api.line.me/v2/bot/message/push"
+LINE_MULTICAST_ENDPOINT = "https://api.line.me/v2/bot/message/multicast"
+MULTICAST_MAX_TO = 500  # multicast 1 回あたりの宛先上限
+# 店舗内の push を同時に投げる上限（LINE のレート制限を超えない範囲）
+LINE_PUSH_CONCURRENCY = int(os.getenv("LINE_PUSH_CONCURRENCY") or os.getenv("LINE_CONCURRENCY") or "20")
+# 同時に処理する店舗数
+SHOP_CONCURRENCY = int(os.getenv("SHOP_CONCURRENCY", "8"))
+# LINE への接続は 3.05 秒で見切る（読み取りは 10 秒）。接続が張れないときに読み取りの 10 秒まで待たない
+LINE_TIMEOUT = httpx.Timeout(10, connect=3.05)
+
+# LINE へ送る JSON のシリアライズ。orjson があれば使う（Content-Type は _line_headers で付与）
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    _dumps = lambda o: json.dumps(o, ensure_ascii=False).encode("utf-8")
+
+try:
+    import h2  # noqa: F401  httpx の HTTP/2 は h2 があるときだけ有効
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
 TRACKING_BASE = (
     "https://misenavi-tracking-rbsey36xe-haya5050akibahu-6610s-projects.vercel.app"
@@ -54,7 +90,17 @@ def require_supabase_env():
 
 print(f"[ENV] SUPABASE_URL_suffix={_url_suffix(SUPABASE_URL)}", flush=True)
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_SERVICE_ROLE_KEY,
+    options=ClientOptions(postgrest_client_timeout=httpx.Timeout(10.0, connect=5.0)),
+)
+# PostgREST クライアント（内部の httpx.Client）は初回アクセス時に遅延生成される。
+# 店舗スレッドから同時に触ると別々のコネクションプールができるので、ここで 1 つ作って共有する
+_postgrest = supabase.postgrest
+# 接続数の上限（httpx.Limits）は supabase-py 2.7.4 の ClientOptions では渡せず、自前の httpx_client を
+# 渡す口もまだ無い。内部の session を差し替えるのは非公開 API 依存になるので、httpx の既定の
+# Limits（keep-alive 20 / 最大 100）のまま使う。上限が必要になったら supabase の pin を上げて対応する
 
 # 互換のため残すが、運用では user_id 固定（line_user_id は一切使わない）
 USER_KEY_COL = os.getenv("USER_KEY_COL", "").strip() or None
@@ -73,19 +119,121 @@ def jst_now() -> datetime:
 # shops.yaml
 # =========================================================
 
+# 常駐コンテナでは同じファイルを何度も読むので、(path, mtime_ns) でパース結果を使い回す
+_SHOPS_CACHE: Dict[Tuple[str, int], Dict[str, Dict]] = {}
+
+
+def make_renderer(tpl: Optional[str]) -> Optional[Callable[[str], str]]:
+    """
+    tpl.format(name=...) と同じ結果を返す関数を作る。
+    書式の解析は最初の 1 回だけにして、ユーザーごとは文字列の連結だけで済ませる。
+    {name} 以外のフィールドや書式指定（{name!r} / {name:>5} など）があるときは format にそのまま任せる。
+    """
+    if not tpl:
+        return None
+    parts = list(string.Formatter().parse(tpl))
+    if any(field not in (None, "name") or spec or conv for _, field, spec, conv in parts):
+        return lambda name: tpl.format(name=name)
+    if all(field is None for _, field, _, _ in parts):
+        text = "".join(lit for lit, _, _, _ in parts)
+        return lambda name: text
+    pieces = [(lit, field is not None) for lit, field, _, _ in parts]
+    return lambda name: "".join(lit + name if has_field else lit for lit, has_field in pieces)
+
+
+@dataclass(frozen=True)
+class ShopCoupon:
+    """shops.yaml の 1 店舗分から、クーポン送信に使う値をフォールバック込みで解決したもの"""
+    coupon_url: Optional[str]
+    img7: Optional[str]
+    msg7_tpl: Optional[str]
+    img30: Optional[str]
+    msg30_tpl: Optional[str]
+    render7: Optional[Callable[[str], str]]
+    render30: Optional[Callable[[str], str]]
+
+    @classmethod
+    def from_conf(cls, conf: Dict) -> "ShopCoupon":
+        img7 = conf.get("coupon7_image")
+        msg7_tpl = conf.get("coupon_after_7days")
+        msg30_tpl = conf.get("coupon_after_30days") or msg7_tpl
+        return cls(
+            coupon_url=conf.get("coupon_url"),
+            img7=img7,
+            msg7_tpl=msg7_tpl,
+            img30=conf.get("coupon30_image") or img7,
+            msg30_tpl=msg30_tpl,
+            render7=make_renderer(msg7_tpl),
+            render30=make_renderer(msg30_tpl),
+        )
+
+
+# load_shops で読み込んだ店舗ごとの解決済み設定（shop_id -> (元の conf, ShopCoupon)）
+_SHOP_COUPONS: Dict[str, Tuple[Dict, ShopCoupon]] = {}
+
+
+def shop_coupon(shop_id: str, shop_conf: Dict) -> ShopCoupon:
+    cached = _SHOP_COUPONS.get(shop_id)
+    if cached is not None and cached[0] is shop_conf:
+        return cached[1]
+    # load_shops を通っていない conf（テスト・手動実行）はその場で解決する
+    return ShopCoupon.from_conf(shop_conf)
+
+
+# cron で毎回別プロセスになるので、YAML のパース結果を JSON にしてプロセスをまたいで使い回す
+SHOPS_JSON_CACHE = CONFIG_DIR / "shops.yaml.cache.json"
+
+
+def _read_shops_json_cache(mtime_ns: int) -> Optional[Dict]:
+    try:
+        with SHOPS_JSON_CACHE.open("r", encoding="utf-8") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # shops.yaml が書き換わっていたら使わない（mtime は cache 作成時の YAML のもの）
+    if not isinstance(cached, dict) or cached.get("mtime_ns") != mtime_ns:
+        return None
+    return cached.get("raw")
+
+
+def _write_shops_json_cache(mtime_ns: int, raw: Dict) -> None:
+    tmp = SHOPS_JSON_CACHE.with_name(f"{SHOPS_JSON_CACHE.name}.{os.getpid()}.tmp")
+    try:
+        # 日付など JSON にできない値を含む YAML はキャッシュしない（毎回 YAML を読む）
+        text = json.dumps({"mtime_ns": mtime_ns, "raw": raw}, ensure_ascii=False)
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, SHOPS_JSON_CACHE)
+    except (TypeError, ValueError, OSError):
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
 def load_shops() -> Dict[str, Dict]:
     if not SHOPS_YAML.exists():
         print("[ERROR] shops.yaml not found", file=sys.stderr, flush=True)
         return {}
 
-    with SHOPS_YAML.open("r", encoding="utf-8") as f:
-        raw = yaml.safe_load(f) or {}
+    key = (str(SHOPS_YAML), SHOPS_YAML.stat().st_mtime_ns)
+    if key in _SHOPS_CACHE:
+        return _SHOPS_CACHE[key]
+
+    raw = _read_shops_json_cache(key[1])
+    if raw is None:
+        with SHOPS_YAML.open("r", encoding="utf-8") as f:
+            raw = yaml.load(f, Loader=_YamlLoader) or {}
+        _write_shops_json_cache(key[1], raw)
 
     shops: Dict[str, Dict] = {}
     for item in raw.get("shops", []):
         sid = item.get("id")
         if sid:
             shops[sid] = item
+    _SHOPS_CACHE.clear()
+    _SHOPS_CACHE[key] = shops
+    _SHOP_COUPONS.clear()
+    _SHOP_COUPONS.update({sid: (conf, ShopCoupon.from_conf(conf)) for sid, conf in shops.items()})
     return shops
 
 
@@ -93,6 +241,30 @@ def load_shops() -> Dict[str, Dict]:
 # LINE
 # =========================================================
 
+@functools.lru_cache(maxsize=256)
+def _load_token_cached(env_path: str, mtime_ns: int) -> Optional[str]:
+    # mtime_ns をキーに含めるので、.env を書き換えれば次の呼び出しで読み直される。
+    # 古い mtime のエントリは lru で押し出されるので、長く動くプロセスでも増え続けない
+    return dotenv_values(env_path).get("LINE_CHANNEL_ACCESS_TOKEN")
+
+
+def _load_env_token(env_path: Path) -> Optional[str]:
+    """
+    .env の LINE_CHANNEL_ACCESS_TOKEN を (path, mtime_ns) 単位でキャッシュして返す（無ければ None）。
+    複数店舗が同じ env_file を共有していても、パースは変更があったときだけ。
+    """
+    try:
+        mtime_ns = env_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _load_token_cached(str(env_path), mtime_ns)
+
+
+@functools.lru_cache(maxsize=64)
+def _env_path(env_file: str) -> Path:
+    return (CONFIG_DIR / env_file).resolve()
+
+
 def load_line_token(shop_conf: Dict) -> Optional[str]:
     env_key = shop_conf.get("line_token_env")
     if env_key:
@@ -104,41 +276,26 @@ def load_line_token(shop_conf: Dict) -> Optional[str]:
     if not env_file:
         return None
 
-    env_path = CONFIG_DIR / env_file
-    if not env_path.exists():
-        return None
+    # 絶対パスに正規化してから引く（"./a.env" と "a.env" のように書き方が違っても同じキャッシュを使う）
+    return _load_env_token(_env_path(env_file))
 
-    envs = dotenv_values(env_path)
-    return envs.get("LINE_CHANNEL_ACCESS_TOKEN")
 
+@functools.lru_cache(maxsize=64)
+def _image_message(image_url: str) -> Dict:
+    # 店舗ごとに画像は固定なので、同じ dict を全員の payload で共有する（送る前に書き換えないこと）
+    return {"type": "image", "originalContentUrl": image_url, "previewImageUrl": image_url}
 
-def send_coupon_message(token: str, user_id: str, text: str, image_url: str) -> bool:
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}",
-    }
-    payload = {
-        "to": user_id,
-        "messages": [
-            {"type": "text", "text": text},
-            {"type": "image", "originalContentUrl": image_url, "previewImageUrl": image_url},
-        ],
-    }
 
-    r = requests.post(LINE_PUSH_ENDPOINT, json=payload, headers=headers, timeout=10)
-    if r.status_code != 200:
-        print(f"[ERROR] LINE push failed uid={user_id} status={r.status_code} body={r.text}", flush=True)
-        return False
-    return True
+def _coupon_messages(text: str, image_url: str) -> List[Dict]:
+    return [{"type": "text", "text": text}, _image_message(image_url)]
 
 
-def send_coupon_flex_message(token: str, user_id: str, text: str, image_url: str, coupon_url: str) -> bool:
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}",
-    }
+def build_coupon_payload(user_id: str, text: str, image_url: str) -> Dict:
+    return {"to": user_id, "messages": _coupon_messages(text, image_url)}
 
-    payload = {
+
+def build_coupon_flex_payload(user_id: str, text: str, image_url: str, coupon_url: str) -> Dict:
+    return {
         "to": user_id,
         "messages": [
             {
@@ -164,112 +321,387 @@ def send_coupon_flex_message(token: str, user_id: str, text: str, image_url: str
         ],
     }
 
-    r = requests.post(LINE_PUSH_ENDPOINT, json=payload, headers=headers, timeout=10)
-    if r.status_code != 200:
-        print(f"[ERROR] LINE flex push failed uid={user_id} status={r.status_code} body={r.text}", flush=True)
-        return False
-    return True
+
+@functools.lru_cache(maxsize=64)
+def _line_headers(token: str) -> Dict[str, str]:
+    # トークンごとに 1 回だけ作って使い回す（呼び出し側で書き換えないこと）
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {token}",
+    }
+
+
+def _push_label(payload: Dict) -> str:
+    return "LINE flex push" if payload["messages"][0].get("type") == "flex" else "LINE push"
+
+
+PUSH_RETRY_STATUS = (429, 500, 502, 503, 504)
+PUSH_MAX_ATTEMPTS = 3
+PUSH_BACKOFF_MAX = 8.0  # 1 回の待ちの上限（秒）。Retry-After もこれで頭打ちにする
+
+
+def _retry_delay(attempt: int, r: Optional[httpx.Response]) -> float:
+    """
+    次の再送までの待ち秒数。429 で Retry-After があればそれに従い、
+    無ければ指数バックオフ + フルジッター（同時に弾かれた push が同じ瞬間に再送しないように）。
+    """
+    if r is not None:
+        ra = r.headers.get("Retry-After")
+        if ra and ra.isdigit():
+            return min(float(ra), PUSH_BACKOFF_MAX)
+    return random.uniform(0, min(PUSH_BACKOFF_MAX, 0.5 * (2 ** attempt)))
+
+
+async def _post_async(client: httpx.AsyncClient, sem: asyncio.Semaphore, token: str,
+                      endpoint: str, payload: Dict, label: str) -> bool:
+    # Retry-Key を付けて、429/5xx はバックオフして投げ直す（重複配信にはならない）
+    # クライアントは店舗をまたいで使い回すので、店舗のトークンはリクエストごとに付ける
+    headers = {**_line_headers(token), "X-Line-Retry-Key": str(uuid.uuid4())}
+    body = _dumps(payload)
+    for attempt in range(PUSH_MAX_ATTEMPTS):
+        async with sem:
+            try:
+                r = await client.post(endpoint, content=body, headers=headers)
+            except httpx.HTTPError as e:
+                r, err = None, e
+        if r is not None and r.status_code in (200, 409):  # 409 = 同じ Retry-Key で受付済み
+            return True
+        if r is not None and r.status_code not in PUSH_RETRY_STATUS:
+            break
+        if attempt + 1 < PUSH_MAX_ATTEMPTS:
+            # 待っている間はセマフォを離して、他の宛先の送信を止めない
+            await asyncio.sleep(_retry_delay(attempt, r))
+    if r is None:
+        print(f"[ERROR] {label} failed error={err!r}", flush=True)
+    else:
+        print(f"[ERROR] {label} failed status={r.status_code} body={r.text}", flush=True)
+    return False
+
+
+# 店舗スレッドごとにイベントループと LINE 用 AsyncClient を 1 組持ち、
+# 同じスレッドが続けて処理する店舗の間で api.line.me への接続（TLS）を使い回す
+_LINE_LOCAL = threading.local()
+_LINE_CLIENTS: List[Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = []
+_LINE_CLIENTS_LOCK = threading.Lock()
+
+
+def _line_client() -> Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]:
+    st = getattr(_LINE_LOCAL, "st", None)
+    if st is None:
+        # 同時送信数より多く接続を張っても使われないので揃える
+        limits = httpx.Limits(max_connections=LINE_PUSH_CONCURRENCY, max_keepalive_connections=LINE_PUSH_CONCURRENCY)
+        st = (asyncio.new_event_loop(), httpx.AsyncClient(http2=_HTTP2, limits=limits, timeout=LINE_TIMEOUT))
+        _LINE_LOCAL.st = st
+        with _LINE_CLIENTS_LOCK:
+            _LINE_CLIENTS.append(st)
+    return st
+
+
+def close_line_clients() -> None:
+    """全店舗の送信が終わってから 1 回だけ呼ぶ。各スレッドの AsyncClient を閉じてループを片付ける"""
+    with _LINE_CLIENTS_LOCK:
+        items = list(_LINE_CLIENTS)
+        _LINE_CLIENTS.clear()
+    for loop, client in items:
+        loop.run_until_complete(client.aclose())
+        loop.close()
+
+
+async def _send_all(
+    client: httpx.AsyncClient,
+    token: str,
+    pairs: List[Tuple[str, Dict]],
+    multicasts: List[Tuple[List[str], List[Dict]]],
+) -> Tuple[List[bool], List[List[str]]]:
+    # 同時送信数は店舗ごとに LINE_PUSH_CONCURRENCY まで
+    sem = asyncio.Semaphore(LINE_PUSH_CONCURRENCY)
+
+    # multicast は MULTICAST_MAX_TO 人ずつのチャンクを 1 リクエストとして push と同じ列に並べる
+    parts = [
+        (k, uids[i:i + MULTICAST_MAX_TO], messages)
+        for k, (uids, messages) in enumerate(multicasts)
+        for i in range(0, len(uids), MULTICAST_MAX_TO)
+    ]
+    results = await asyncio.gather(
+        *(_post_async(client, sem, token, LINE_PUSH_ENDPOINT, payload, f"{_push_label(payload)} uid={uid}")
+          for uid, payload in pairs),
+        *(_post_async(client, sem, token, LINE_MULTICAST_ENDPOINT, {"to": part, "messages": messages},
+                      f"LINE multicast n={len(part)}")
+          for _, part, messages in parts),
+        return_exceptions=True,
+    )
+
+    pushed = [r is True for r in results[:len(pairs)]]
+    sent: List[List[str]] = [[] for _ in multicasts]
+    for (k, part, _), r in zip(parts, results[len(pairs):]):
+        if r is True:
+            sent[k].extend(part)
+    return pushed, sent
+
+
+def send_all(
+    token: str,
+    pairs: List[Tuple[str, Dict]],
+    multicasts: Optional[List[Tuple[List[str], List[Dict]]]] = None,
+) -> Tuple[List[bool], List[List[str]]]:
+    """
+    店舗分の push（(uid, payload)）と multicast（(uids, messages)）を 1 つのイベントループで同時に送る。
+    戻り: (push の成否を入力順に, multicast ごとの送信できた uid)。
+    1 人ずつ直列に送ると N × RTT かかるので、同時 LINE_PUSH_CONCURRENCY 件まで並べる。
+    """
+    multicasts = multicasts or []
+    if not pairs and not multicasts:
+        return [], []
+    loop, client = _line_client()
+    return loop.run_until_complete(_send_all(client, token, pairs, multicasts))
 
 
 # =========================================================
 # Tracking
 # =========================================================
 
-def build_tracking_url(shop_id: str, coupon_type: str, user_id: str, dest: str) -> str:
+@functools.lru_cache(maxsize=256)
+def _tracking_parts(shop_id: str, coupon_type: str, dest: str) -> Tuple[str, str]:
+    # uid 以外は店舗・クーポン種別ごとに固定なので、dest の quote もここで 1 回だけ
     return (
-        f"{TRACKING_BASE}"
-        f"?shop={shop_id}"
-        f"&type={coupon_type}"
-        f"&uid={user_id}"
-        f"&dest={urllib.parse.quote(dest, safe='')}"
+        f"{TRACKING_BASE}?shop={shop_id}&type={coupon_type}&uid=",
+        f"&dest={urllib.parse.quote(dest, safe='')}",
     )
 
 
+def build_tracking_url(shop_id: str, coupon_type: str, user_id: str, dest: str) -> str:
+    # user_id は LINE の Uxxxx（英数字のみ）なので quote しない
+    head, tail = _tracking_parts(shop_id, coupon_type, dest)
+    return head + user_id + tail
+
+
 # =========================================================
 # DB：キー自動判定 & 冪等性ガード
 # =========================================================
 
+# 互換のため USER_KEY_COL を残すが、通常は "user_id" 以外にしないこと。
+# スキーマは実行中に変わらないので、プロセス起動時に 1 回だけ決める
+_RESOLVED_USER_KEY_COL = USER_KEY_COL or "user_id"
+
+
 def detect_user_key_col(shop_id: str) -> str:
     """
     運用の正：users.user_id に LINE の Uxxxx が入っている。
     line_user_id は使わない / 参照しない（42703 根絶）。
+    DB への問い合わせはせず、店舗によらず同じ値を返す。
     """
-    if USER_KEY_COL:
-        # 互換のため残すが、通常は "user_id" 以外にしないこと
-        return USER_KEY_COL
-    return "user_id"
-
-
-def already_sent_today(shop_id: str, user_id: str, coupon_type: str, now_utc: datetime) -> bool:
-    day_start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-    day_end = (now_utc.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)).isoformat()
-
-    res = (
-        supabase.table("coupon_send_logs")
-        .select("id")
-        .eq("shop_id", shop_id)
-        .eq("user_id", user_id)
-        .eq("coupon_type", coupon_type)
-        .gte("sent_at", day_start)
-        .lt("sent_at", day_end)
-        .limit(1)
-        .execute()
-    )
-    return bool(res.data)
+    return _RESOLVED_USER_KEY_COL
+
+
+def _utc_day_range(now_utc: datetime) -> Tuple[str, str]:
+    day_start = now_utc.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day_start.isoformat(), (day_start + timedelta(days=1)).isoformat()
+
+
+# in_() は URL のクエリに展開されるので、LINE の uid（33文字）でも URL 長の上限に収まる件数ずつ引く
+SENT_LOOKUP_CHUNK = 200
+
+
+def fetch_sent_today_map(
+    shop_id: str, coupon_types: List[str], uids: List[str], day_range: Tuple[str, str]
+) -> Dict[str, set]:
+    """
+    coupon_type ごとの「今日すでに送った user_id」の集合。
+    複数のクーポン種別・対象者をまとめて IN 句で引く（チャンクごとに 1 回）。
+    day_range は _utc_day_range() の戻り値（実行ごとに 1 回だけ計算して渡す）。
+    """
+    day_start, day_end = day_range
+    sent: Dict[str, set] = {ct: set() for ct in coupon_types}
+    uniq = list(dict.fromkeys(uids))
+    for i in range(0, len(uniq), SENT_LOOKUP_CHUNK):
+        res = (
+            supabase.table("coupon_send_logs")
+            .select("user_id,coupon_type")
+            .eq("shop_id", shop_id)
+            .in_("coupon_type", coupon_types)
+            .gte("sent_at", day_start)
+            .lt("sent_at", day_end)
+            .in_("user_id", uniq[i:i + SENT_LOOKUP_CHUNK])
+            .execute()
+        )
+        for r in res.data or []:
+            sent.setdefault(r["coupon_type"], set()).add(r["user_id"])
+    return sent
 
 
 # =========================================================
 # DB 共通
 # =========================================================
 
-def fetch_targets_from_db(
+# PostgREST の max-rows（Supabase 既定 1000）を超えないページサイズ
+USERS_PAGE_SIZE = 1000
+
+
+def _iter_user_pages(make_query: Callable[[], object], page: int = USERS_PAGE_SIZE) -> Iterator[List[Dict]]:
+    """
+    users を user_id のキーセットで USERS_PAGE_SIZE 件ずつ引く。
+    make_query() は select とフィルタまで組んだクエリを毎回新しく返すこと（order / limit はここで付ける）。
+    limit 1 回で引くと max-rows で黙って切れるので、件数が多い店舗でも取りこぼさない。
+    同じ user_id の重複行は 2 ページ目以降に跨ると読み飛ばされるが、どのみち 1 人 1 通にまとめる。
+    """
+    last: Optional[str] = None
+    while True:
+        q = make_query()
+        if last is not None:
+            q = q.gt("user_id", last)
+        rows = q.order("user_id").limit(page).execute().data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page:
+            return
+        last = rows[-1]["user_id"]
+
+
+def _parse_ts(v: Optional[str]) -> Optional[datetime]:
+    # PostgREST の timestamptz（"Z" / "+00:00"、小数秒の桁数まちまち）を比較できる形にする
+    if not v:
+        return None
+    try:
+        return datetime.fromisoformat(v.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+# 登録からの日数ごとのクーポン（days, users の送信済み列）。増やすときはここに足すだけで 1 クエリのまま
+COUPON_MILESTONES: Tuple[Tuple[int, str], ...] = (
+    (7, "coupon7_sent_at"),
+    (30, "coupon30_sent_at"),
+)
+# 送信済み列 -> coupon_send_logs.coupon_type
+COUPON_TYPE_BY_COL: Dict[str, str] = {col: f"{days}days" for days, col in COUPON_MILESTONES}
+
+
+def fetch_coupon_targets(
     shop_id: str,
     now_utc: datetime,
-    days: int,
-    sent_col: str,
     user_key_col: str,
-    limit: int = 5000,
-) -> List[Dict]:
-    cutoff = (now_utc - timedelta(days=days)).isoformat()
+) -> Tuple[List[Dict], ...]:
+    """
+    COUPON_MILESTONES の全クーポンの対象者を 1 つの SELECT（ページ単位）で引き、Python 側で振り分ける。
+    戻り値は COUPON_MILESTONES と同じ順（今は (targets7, targets30)）で、
+    種類ごとに「送信済み列が NULL かつ registered_at <= 日数前」で引くのと同じ結果になる。
+    """
+    cutoffs = [(now_utc - timedelta(days=days), col) for days, col in COUPON_MILESTONES]
+    # 「まだ送っていない かつ 日数を過ぎた」のどれかに当たる行だけ返す
+    cond = ",".join(f"and({col}.is.null,registered_at.lte.{cutoff.isoformat()})" for cutoff, col in cutoffs)
+    cols = ",".join(["user_id", "display_name", "registered_at"] + [col for _, col in COUPON_MILESTONES])
 
     # ★ line_user_id を絶対に SELECT しない
-    res = (
-        supabase.table("users")
-        .select("user_id,display_name,registered_at")
-        .eq("shop_id", shop_id)
-        .is_(sent_col, None)
-        .lte("registered_at", cutoff)
-        .limit(limit)
-        .execute()
-    )
+    def query():
+        return (
+            supabase.table("users")
+            .select(cols)
+            .eq("shop_id", shop_id)
+            .or_(cond)
+            .not_.is_("user_id", None)
+        )
+
+    # 返ってくる行は WHERE で「未送信のどれかの日数を過ぎている」ことが保証されている。
+    # 未送信の列のうち一番ゆるい（日数が短い）ものは必ず満たすので日付を見ずに入れ、
+    # 日付の比較（timestamptz のパース）は未送信が 2 つ以上ある行の残りの判定だけにする
+    loosest_first = sorted(range(len(cutoffs)), key=lambda k: cutoffs[k][0], reverse=True)
+    buckets: List[List[Dict]] = [[] for _ in cutoffs]
+    for rows in _iter_user_pages(query):
+        for r in rows:
+            # ★ UID は user_id 固定（NULL は DB 側で除外済み）
+            r["_uid"] = r["user_id"]
+            unsent = [k for k in loosest_first if r.get(cutoffs[k][1]) is None]
+            if not unsent:
+                continue
+            buckets[unsent[0]].append(r)
+            if len(unsent) > 1:
+                reg = _parse_ts(r.get("registered_at"))
+                if reg is None:
+                    continue
+                for k in unsent[1:]:
+                    if reg <= cutoffs[k][0]:
+                        buckets[k].append(r)
+    return tuple(buckets)
+
+
+# DB に一括更新用の関数を入れてある環境では、その名前を MARK_SENT_RPC に設定する。
+# 宛先 uid を POST ボディで渡すので、IN 句のように URL 長で分割しなくてよい（店舗・列ごとに 1 回）。
+# 想定している定義（列名は coupon7_sent_at / coupon30_sent_at に限定すること）:
+#   create function mark_sent_bulk(_shop_id text, _col text, _ids text[], _ts timestamptz)
+#   returns integer ...  -- UPDATE users SET <_col> = _ts WHERE shop_id = _shop_id AND user_id = ANY(_ids)
+MARK_SENT_RPC = os.getenv("MARK_SENT_RPC", "").strip() or None
+
+
+def mark_sent_bulk(shop_id: str, uids: List[str], sent_col: str, sent_at: str) -> int:
+    """
+    同じ sent_at を複数ユーザーにまとめて付ける。
+    MARK_SENT_RPC があれば RPC 1 回、無ければ IN 句で SENT_LOOKUP_CHUNK 件ずつ UPDATE する。
+    戻り値は実際に更新された行数（DIAG 用）。
+    """
+    uniq = list(dict.fromkeys(uids))
+    if MARK_SENT_RPC:
+        try:
+            res = supabase.rpc(
+                MARK_SENT_RPC, {"_shop_id": shop_id, "_col": sent_col, "_ids": uniq, "_ts": sent_at}
+            ).execute()
+            updated = res.data if isinstance(res.data, int) else len(uniq)
+            if updated != len(uniq):
+                print(f"[DIAG] mark_sent_bulk shop={shop_id} col={sent_col} requested={len(uniq)} updated={updated}", flush=True)
+            return updated
+        except Exception as e:
+            # RPC が無い・失敗したときは従来の UPDATE に落とす
+            print(f"[WARN] {MARK_SENT_RPC} rpc failed, falling back to UPDATE: {e}", flush=True)
+
+    updated = 0
+    for i in range(0, len(uniq), SENT_LOOKUP_CHUNK):
+        chunk = uniq[i:i + SENT_LOOKUP_CHUNK]
+        try:
+            res = (
+                supabase.table("users")
+                .update({sent_col: sent_at})
+                .eq("shop_id", shop_id)
+                .in_("user_id", chunk)
+                .execute()
+            )
+            updated += len(res.data or [])
+        except Exception as e:
+            print(f"[ERROR] users {sent_col} update failed rows={len(chunk)} error={e}", flush=True)
+    if updated != len(uniq):
+        print(f"[DIAG] mark_sent_bulk shop={shop_id} col={sent_col} requested={len(uniq)} updated={updated}", flush=True)
+    return updated
 
-    rows = res.data or []
-    for r in rows:
-        # ★ UID は user_id 固定（user_key_col が user_id 以外でも user_id を優先）
-        r["_uid"] = r.get("user_id") or r.get(user_key_col)
 
-    return [r for r in rows if r.get("_uid")]
+LOG_INSERT_CHUNK = 500
 
 
-def mark_sent(shop_id: str, uid: str, sent_col: str, sent_at: str, user_key_col: str):
+def insert_coupon_send_logs(rows: List[Dict]):
     """
-    更新キーも user_id 固定を推奨。
-    user_key_col を残しているのは最小差分のため。
+    店舗分の送信ログを 500 行ずつ bulk insert する。
+    一部のチャンクが失敗してもジョブは止めない（送信自体は完了しているため）。
+    失敗したチャンクの行は後から入れ直せるよう、1 行 1 JSON で stderr に出す。
     """
-    # ★ まず user_id で更新（運用の正）
-    supabase.table("users").update({sent_col: sent_at}).eq("shop_id", shop_id).eq("user_id", uid).execute()
-
-
-def insert_coupon_send_logs(rows: List[Dict]):
-    if rows:
-        supabase.table("coupon_send_logs").insert(rows).execute()
+    for i in range(0, len(rows), LOG_INSERT_CHUNK):
+        chunk = rows[i:i + LOG_INSERT_CHUNK]
+        try:
+            supabase.table("coupon_send_logs").insert(chunk).execute()
+        except Exception as e:
+            print(f"[ERROR] coupon_send_logs insert failed rows={len(chunk)} error={e}", flush=True)
+            for row in chunk:
+                print(f"[REPLAY] coupon_send_logs {json.dumps(row, ensure_ascii=False)}", file=sys.stderr, flush=True)
 
 
 # =========================================================
 # 店舗処理
 # =========================================================
 
-def run_for_shop(shop_id: str, shop_conf: Dict, now_jst: datetime):
+def run_for_shop(shop_id: str, shop_conf: Dict, now_jst: datetime,
+                 day_range: Optional[Tuple[str, str]] = None,
+                 logs_out: Optional[List[Dict]] = None):
+    """
+    logs_out を渡すと送信ログはそこへ追記するだけにして、insert は呼び出し側に任せる
+    （main が店舗の終了ごとにメインスレッドで入れる）。省略時はこの店舗分をその場で insert する。
+    """
     print(f"\n[INFO] === shop: {shop_id} ({shop_conf.get('name')}) ===", flush=True)
 
     token = load_line_token(shop_conf)
@@ -278,46 +710,125 @@ def run_for_shop(shop_id: str, shop_conf: Dict, now_jst: datetime):
         return
 
     user_key_col = detect_user_key_col(shop_id)
-    coupon_url = shop_conf.get("coupon_url")
-
-    img7 = shop_conf.get("coupon7_image")
-    msg7_tpl = shop_conf.get("coupon_after_7days")
-
-    img30 = shop_conf.get("coupon30_image") or img7
-    msg30_tpl = shop_conf.get("coupon_after_30days") or msg7_tpl
+    sc = shop_coupon(shop_id, shop_conf)
+    coupon_url = sc.coupon_url
 
     now_utc = now_jst.astimezone(timezone.utc)
+    if day_range is None:
+        day_range = _utc_day_range(now_utc)
 
-    targets7 = fetch_targets_from_db(shop_id, now_utc, 7, "coupon7_sent_at", user_key_col)
-    targets30 = fetch_targets_from_db(shop_id, now_utc, 30, "coupon30_sent_at", user_key_col)
+    targets7, targets30 = fetch_coupon_targets(shop_id, now_utc, user_key_col)
 
-    logs: List[Dict] = []
+    # 今日の送信済みは 7日/30日 の両方をまとめて 1 回で引く
+    sent_today_map = fetch_sent_today_map(
+        shop_id, ["7days", "30days"], [t["_uid"] for t in targets7 + targets30], day_range
+    )
 
-    for days, targets, sent_col, tpl, img in [
-        (7, targets7, "coupon7_sent_at", msg7_tpl, img7),
-        (30, targets30, "coupon30_sent_at", msg30_tpl, img30),
+    # 7日・30日の両方が対象の人（7日分を取りこぼしたまま30日を迎えた人）には 30日クーポンだけを送り、
+    # 送れたら coupon7_sent_at も埋める（後から 7日クーポンが届かないように）
+    due30 = {t["_uid"] for t in targets30} - sent_today_map["30days"]
+    skip7 = {t["_uid"] for t in targets7} & due30
+    if skip7:
+        targets7 = [t for t in targets7 if t["_uid"] not in skip7]
+
+    # 送信対象を先に全部組み立ててから、店舗単位でまとめて送る。
+    # 文面が全員同じになる（テンプレが名前を使わず、トラッキングURLも無い）ものは multicast、
+    # 人ごとに中身が変わるものは並行 push
+    jobs: List[Tuple[str, str]] = []           # (sent_col, ctype)
+    pairs: List[Tuple[str, Dict]] = []         # (uid, payload)
+    multicasts: List[Tuple[str, str, str, str, List[str]]] = []  # (sent_col, ctype, text, img, uids)
+    for days, targets, sent_col, render, img in [
+        (7, targets7, "coupon7_sent_at", sc.render7, sc.img7),
+        (30, targets30, "coupon30_sent_at", sc.render30, sc.img30),
     ]:
+        ctype = f"{days}days"
+        sent_today = sent_today_map[ctype]
+
+        # 名前を変えても文面が変わらない = 全員同じメッセージ
+        if render and not coupon_url and render("a") == render("b"):
+            uids = [uid for uid in dict.fromkeys(t["_uid"] for t in targets) if uid not in sent_today]
+            sent_today.update(uids)
+            if uids:
+                multicasts.append((sent_col, ctype, render(""), img, uids))
+            continue
+
+        # トラッキングURLが無ければ、名前入りでも文面が同じ人（名前未設定・同名）はまとめて multicast できる
+        by_text: Dict[str, List[str]] = {}
         for t in targets:
             uid = t["_uid"]
+            if uid in sent_today:
+                continue
+            # users に同じ uid の行が重複していても、同じ実行内で 2 通送らない
+            sent_today.add(uid)
+
             name = (t.get("display_name") or "").strip()
-            text = tpl.format(name=name) if tpl else f"{name}さん、登録{days}日記念のクーポンです。"
-            ts = now_utc.isoformat()
-            ctype = f"{days}days"
+            text = render(name) if render else f"{name}さん、登録{days}日記念のクーポンです。"
+
+            if coupon_url:
+                jobs.append((sent_col, ctype))
+                pairs.append((uid, build_coupon_flex_payload(
+                    uid, text, img, build_tracking_url(shop_id, ctype, uid, coupon_url)
+                )))
+            else:
+                by_text.setdefault(text, []).append(uid)
+
+        for text, uids in by_text.items():
+            if len(uids) > 1:
+                multicasts.append((sent_col, ctype, text, img, uids))
+            else:
+                jobs.append((sent_col, ctype))
+                pairs.append((uids[0], build_coupon_payload(uids[0], text, img)))
+
+    ts = now_utc.isoformat()
+    # 送信成功分は sent_col ごとに溜めて、最後にまとめて UPDATE する
+    sent_by_col: Dict[str, List[str]] = {"coupon7_sent_at": [], "coupon30_sent_at": []}
+    # push と multicast は 1 回のイベントループでまとめて並行に送る
+    pushed, mc_sent = send_all(
+        token, pairs, [(uids, _coupon_messages(text, img)) for _, _, text, img, uids in multicasts]
+    )
+    for (uid, _), (sent_col, _), ok in zip(pairs, jobs, pushed):
+        if ok:
+            sent_by_col[sent_col].append(uid)
+    for (sent_col, _, _, _, _), sent in zip(multicasts, mc_sent):
+        sent_by_col[sent_col].extend(sent)
 
-            if already_sent_today(shop_id, uid, ctype, now_utc):
-                continue
+    # 送信ログは送れた分からまとめて作る（skip7 で埋める coupon7_sent_at は送っていないので含めない）
+    logs = [
+        {"shop_id": shop_id, "user_id": uid, "coupon_type": COUPON_TYPE_BY_COL[sent_col], "sent_at": ts}
+        for sent_col, uids in sent_by_col.items()
+        for uid in uids
+    ]
 
-            ok = (
-                send_coupon_flex_message(token, uid, text, img, build_tracking_url(shop_id, ctype, uid, coupon_url))
-                if coupon_url else
-                send_coupon_message(token, uid, text, img)
-            )
+    if skip7:
+        sent_by_col["coupon7_sent_at"].extend(uid for uid in sent_by_col["coupon30_sent_at"] if uid in skip7)
 
-            if ok:
-                mark_sent(shop_id, uid, sent_col, ts, user_key_col)
-                logs.append({"shop_id": shop_id, "user_id": uid, "coupon_type": ctype, "sent_at": ts})
+    for sent_col, uids in sent_by_col.items():
+        if uids:
+            mark_sent_bulk(shop_id, uids, sent_col, ts)
 
-    insert_coupon_send_logs(logs)
+    if logs_out is None:
+        insert_coupon_send_logs(logs)
+    else:
+        logs_out.extend(logs)
+
+
+# =========================================================
+# DEBUG SIGNATURE
+# =========================================================
+
+def _runtime_sig():
+    # 診断用なので PRINT_RUNTIME_SIG が設定されているときだけ（通常の起動では何もしない）
+    if not os.getenv("PRINT_RUNTIME_SIG"):
+        return
+    try:
+        p = os.path.abspath(__file__)
+        with open(p, "rb") as f:
+            sha = hashlib.file_digest(f, "sha256").hexdigest()
+        print(f"[RUNTIME_DAILY] file={p}", flush=True)
+        print(f"[RUNTIME_DAILY] sha256={sha}", flush=True)
+        print(f"[RUNTIME_DAILY] cwd={os.getcwd()}", flush=True)
+    except Exception as e:
+        print(f"[RUNTIME_DAILY][ERROR] {e}", flush=True)
 
 
 # =========================================================
@@ -330,24 +841,32 @@ def main():
     print("=== daily_coupon_job START ===", flush=True)
 
     now = jst_now()
+    # 「今日」の範囲は全店舗共通なので 1 回だけ計算する
+    day_range = _utc_day_range(now.astimezone(timezone.utc))
     shops = load_shops()
-    for sid, conf in shops.items():
-        run_for_shop(sid, conf, now)
+    if not shops:
+        return
+    # 店舗どうしは独立しているので並行に回す（各店舗の中身は Supabase / LINE 待ちがほとんど）
+    # 店舗スレッドが同じ .env を同時に読みにいかないよう、使われる env_file を先に 1 回ずつ読んでおく
+    for env_file in {c["env_file"] for c in shops.values() if c.get("env_file")}:
+        _load_env_token(_env_path(env_file))
+
+    # 送信ログは店舗が終わった順にメインスレッドで入れる（LOG_INSERT_CHUNK 行ずつ）。
+    # 最後にまとめて入れると、途中でジョブが落ちたとき全店舗分のログが消えるため
+    with ThreadPoolExecutor(max_workers=min(SHOP_CONCURRENCY, len(shops))) as ex:
+        futs = {}
+        for sid, conf in shops.items():
+            logs: List[Dict] = []
+            futs[ex.submit(run_for_shop, sid, conf, now, day_range, logs)] = (sid, logs)
+        for f in as_completed(futs):
+            sid, logs = futs[f]
+            try:
+                f.result()
+            except Exception as e:
+                print(f"[ERROR] shop={sid}: {e}", flush=True)
+            insert_coupon_send_logs(logs)
+    close_line_clients()
 
 
 if __name__ == "__main__":
     main()
-
-
-# ===== DEBUG SIGNATURE =====
-import os as _os, hashlib as _hashlib
-
-def _runtime_sig():
-    try:
-        p = _os.path.abspath(__file__)
-        b = open(p, "rb").read()
-        print(f"[RUNTIME_DAILY] file={p}", flush=True)
-        print(f"[RUNTIME_DAILY] sha256={_hashlib.sha256(b).hexdigest()}", flush=True)
-        print(f"[RUNTIME_DAILY] cwd={_os.getcwd()}", flush=True)
-    except Exception as e:
-        print(f"[RUNTIME_DAILY][ERROR] {e}", flush=True)
@@ -7,6 +7,11 @@ from datetime import datetime, timedelta, timezone
 import csv
 import yaml
 
+try:  # libyaml があれば C 実装のパーサを使う
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 JST = timezone(timedelta(hours=9))
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
@@ -23,7 +28,7 @@ def load_shops():
       のような構造を {shopA: {...}, shopB: {...}} に変換して返す
     """
     with SHOPS_YAML.open("r", encoding="utf-8") as f:
-        raw = yaml.safe_load(f) or {}
+        raw = yaml.load(f, Loader=_YamlLoader) or {}
 
     shops = {}
 
@@ -52,68 +57,59 @@ def users_csv_path(shop_id: str) -> Path:
     return shop_dir / "users.csv"
 
 
+USERS_CSV_FIELDS = (
+    "user_id",
+    "display_name",
+    "registered_at",
+    "coupon7_sent_at",
+    "coupon30_sent_at",
+)
+
+
 def init_users_csv_if_needed(shop_id: str):
     path = users_csv_path(shop_id)
     if not path.exists():
         with path.open("w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(
-                f,
-                fieldnames=[
-                    "user_id",
-                    "display_name",
-                    "registered_at",
-                    "coupon7_sent_at",
-                    "coupon30_sent_at",
-                ],
-            )
-            writer.writeheader()
+            csv.writer(f).writerow(USERS_CSV_FIELDS)
 
 
 def load_users(shop_id: str):
+    """
+    users.csv を (header, idx, rows) で返す。
+    行ごとの dict を作らず list のまま持ち、列は idx[列名] で引く。
+    """
     init_users_csv_if_needed(shop_id)
-    users = []
     with users_csv_path(shop_id).open("r", encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            users.append(row)
-    return users
+        reader = csv.reader(f)
+        header = next(reader, None) or list(USERS_CSV_FIELDS)
+        idx = {h: i for i, h in enumerate(header)}
+        rows = [row for row in reader if row]
+    return header, idx, rows
 
 
-def save_users(shop_id: str, users):
+def save_users(shop_id: str, header, rows):
     path = users_csv_path(shop_id)
     with path.open("w", encoding="utf-8", newline="") as f:
-        fieldnames = [
-            "user_id",
-            "display_name",
-            "registered_at",
-            "coupon7_sent_at",
-            "coupon30_sent_at",
-        ]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in users:
-            writer.writerow(row)
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
 
 
 def upsert_user(shop_id: str, user_id: str, registered_at):
-    users = load_users(shop_id)
+    header, idx, rows = load_users(shop_id)
+    i_uid = idx["user_id"]
     found = False
-    for row in users:
-        if row.get("user_id") == user_id:
+    for row in rows:
+        if i_uid < len(row) and row[i_uid] == user_id:
             # 既存：登録日は保持、表示名など拡張余地
             found = True
             break
     if not found:
-        users.append(
-            {
-                "user_id": user_id,
-                "display_name": "",
-                "registered_at": registered_at.isoformat(),
-                "coupon7_sent_at": "",
-                "coupon30_sent_at": "",
-            }
-        )
-    save_users(shop_id, users)
+        new_row = [""] * len(header)
+        new_row[i_uid] = user_id
+        new_row[idx["registered_at"]] = registered_at.isoformat()
+        rows.append(new_row)
+    save_users(shop_id, header, rows)
 
 
 @app.route("/line/callback/<shop_id>", methods=["POST"])
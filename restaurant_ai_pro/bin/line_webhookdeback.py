@@ -1,24 +1,51 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import queue
+import threading
+
 from flask import Flask, request
 
 app = Flask(__name__)
 
+# LINE は応答が遅いと再送してくるので、受信は積むだけにして即 200 を返す。
+# 中身の処理（今はログ出力のみ）はバックグラウンドのワーカーで行う。
+_Q: "queue.Queue[dict]" = queue.Queue()
+
+
+def _handle(item: dict) -> None:
+    print("=== got request from LINE ===")
+    print("PATH:", item["path"])
+    print("METHOD:", item["method"])
+    print("HEADERS:", item["headers"])
+    print("BODY:", item["body"].decode("utf-8", errors="replace"))
+
+
+def _worker() -> None:
+    while True:
+        item = _Q.get()
+        try:
+            _handle(item)
+        except Exception as e:
+            print(f"[ERROR] webhook handler failed: {e}")
+        finally:
+            _Q.task_done()
+
+
+threading.Thread(target=_worker, name="webhook-worker", daemon=True).start()
+
+
 # ① デバッグ用：どんなURLでも全部ここで受ける
 @app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
 @app.route("/<path:path>", methods=["GET", "POST"])
 def catch_all(path):
-    print("=== got request from LINE ===")
-    print("PATH:", path)
-    print("METHOD:", request.method)
-    print("HEADERS:", dict(request.headers))
-    try:
-        print("JSON:", request.get_json())
-    except Exception:
-        print("JSON: (parse error)")
-
-    # とりあえず 200 を返す
+    _Q.put_nowait({
+        "path": path,
+        "method": request.method,
+        "headers": dict(request.headers),
+        "body": request.get_data(),
+    })
+    # とりあえず 200 を返す（処理の完了は待たない）
     return "OK", 200
 
 
@@ -1,4 +1,6 @@
+import os
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # ===== 設定 =====
@@ -9,65 +11,94 @@ INPUT_CSV = "/mnt/c/Users/hayato/Downloads/e.csv"
 OUTPUT_DIR = Path("OUTPUT/applicants")
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# 列名リネーム（あなたのCSVに完全一致対応）。ここに無い列は読み込まない
+RENAME_MAP = {
+    "タイムスタンプ": "timestamp",
+    "  1. お名前（必須）  ": "name",
+    "  2. 年齢（必須）  ": "age",
+    "  3. 希望店舗（必須）  ": "shop",
+    "  4. 希望ポジション（必須）  ": "position",
+    "  5. 経験（必須）  ": "experience",
+    "  6. 勤務可能曜日（必須) ": "available_days",
+    "  7. 勤務可能時間帯（任意）  ": "available_times",
+    "  8. 最寄り駅（任意）  ": "nearest_station",
+    "  9. 一言PR（任意）  ": "comment",
+}
+
+# pyarrow があれば CSV パーサに使う（無ければ C エンジン）
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+
+def read_applicants(path):
+    """使う列だけを文字列として読む（型推論と不要列のパースを省く）"""
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in header if c in RENAME_MAP]
+    return pd.read_csv(path, engine=CSV_ENGINE, usecols=usecols, dtype=str)
 
-# ===== スコアリングロジック =====
-def score_applicant(row):
-    score = 0
-
-    # 飲食経験あり → +3
-    if "あり" in str(row.get("experience", "")):
-        score += 3
-
-    # どちらでも → +2
-    if "どちらでも" in str(row.get("position", "")):
-        score += 2
-
-    # 曜日（全角・半角カンマ対応）
-    days_str = str(row.get("available_days", ""))
-    days_str = days_str.replace(" ", "").replace("、", ",")
-    num_days = len([d for d in days_str.split(",") if d])
-
-    if num_days >= 4:
-        score += 3
-    elif num_days >= 2:
-        score += 1
-
-    # 年齢（18〜30歳 → +1）
-    try:
-        age = int(str(row.get("age", "")).strip())
-        if 18 <= age <= 30:
-            score += 1
-    except:
-        pass
 
+# ===== スコアリングロジック =====
+def _col_str(df, col):
+    """列を文字列 Series で返す（列が無ければ空文字）"""
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].fillna("").astype(str)
+
+
+def score_applicants(df):
+    """
+    応募者ごとのスコアを列演算でまとめて計算する（行ごとの apply はしない）。
+      - 飲食経験あり → +3
+      - どちらでも → +2
+      - 勤務可能曜日 4日以上 → +3 / 2〜3日 → +1
+      - 年齢 18〜30歳 → +1
+    """
+    exp = _col_str(df, "experience")
+    pos = _col_str(df, "position")
+
+    # 曜日（全角・半角カンマ対応）。空要素は数えない
+    days = _col_str(df, "available_days").str.replace(" ", "", regex=False).str.replace("、", ",", regex=False)
+    num_days = days.str.count(r"[^,]+")
+
+    # 年齢（全角数字も可）。数値にならないものは加点なし
+    age = pd.to_numeric(_col_str(df, "age").str.normalize("NFKC").str.strip(), errors="coerce")
+
+    score = (
+        exp.str.contains("あり", regex=False).astype(int) * 3
+        + pos.str.contains("どちらでも", regex=False).astype(int) * 2
+        + (num_days >= 4).astype(int) * 3
+        + ((num_days >= 2) & (num_days < 4)).astype(int)
+        + age.between(18, 30).astype(int)
+    )
     return score
 
 
+def write_csvs_parallel(items):
+    """(DataFrame, 出力パス) の組をスレッドで並列に CSV 出力する"""
+    items = list(items)
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=min(len(items), os.cpu_count() or 1)) as ex:
+        # list() で待ち合わせつつ、書き込み中の例外をここで送出させる
+        list(ex.map(lambda t: t[0].to_csv(t[1], index=False), items))
+
+
 # ===== メイン処理 =====
 def main():
-    # --- 1. CSV読み込み ---
-    df = pd.read_csv(INPUT_CSV)
-
-    # --- 2. 列名リネーム（あなたのCSVに完全一致対応） ---
-    rename_map = {
-        "タイムスタンプ": "timestamp",
-        "  1. お名前（必須）  ": "name",
-        "  2. 年齢（必須）  ": "age",
-        "  3. 希望店舗（必須）  ": "shop",
-        "  4. 希望ポジション（必須）  ": "position",
-        "  5. 経験（必須）  ": "experience",
-        "  6. 勤務可能曜日（必須) ": "available_days",
-        "  7. 勤務可能時間帯（任意）  ": "available_times",
-        "  8. 最寄り駅（任意）  ": "nearest_station",
-        "  9. 一言PR（任意）  ": "comment",
-    }
-    df = df.rename(columns=rename_map)
+    # --- 1. CSV読み込み（使う列だけ） ---
+    df = read_applicants(INPUT_CSV)
+
+    # --- 2. 列名リネーム ---
+    df = df.rename(columns=RENAME_MAP)
 
     # --- 3. 前処理（余計な空白・全角スペース除去） ---
     df["shop"] = df["shop"].astype(str).str.strip().str.replace("　", "")
 
     # --- 4. スコア列追加 ---
-    df["score"] = df.apply(score_applicant, axis=1)
+    df["score"] = score_applicants(df)
 
     # --- 5. スコア順ソート ---
     df_sorted = df.sort_values("score", ascending=False)
@@ -77,30 +108,34 @@ def main():
     df_sorted.to_csv(all_out_path, index=False)
     print(f"[INFO] 全体一覧 → {all_out_path}")
 
-        # --- 7. 店舗ごとに仕分けて出力（店内順位付き） ---
-    for shop_name, sub_df in df_sorted.groupby("shop"):
-        sub_df = sub_df.sort_values("score", ascending=False).reset_index(drop=True)
-        sub_df.insert(0, "rank_in_shop", sub_df.index + 1)
-
-        # 見せたい列だけに絞る（店ごとの見やすい表）
-        cols_shop = [
-            "rank_in_shop",
-            "name",
-            "age",
-            "position",
-            "experience",
-            "available_days",
-            "available_times",
-            "score",
-            "timestamp",
-            "nearest_station",
-            "comment",
-        ]
-        sub_df = sub_df[cols_shop]
-
+    # --- 7. 店舗ごとに仕分けて出力（店内順位付き） ---
+    # 店内順位は店舗・スコア順に並べ直してから groupby.cumcount で一括計算
+    df_ranked = df_sorted.sort_values(["shop", "score"], ascending=[True, False], kind="stable").reset_index(drop=True)
+    df_ranked.insert(0, "rank_in_shop", df_ranked.groupby("shop").cumcount() + 1)
+
+    # 見せたい列だけに絞る（店ごとの見やすい表）
+    cols_shop = [
+        "rank_in_shop",
+        "name",
+        "age",
+        "position",
+        "experience",
+        "available_days",
+        "available_times",
+        "score",
+        "timestamp",
+        "nearest_station",
+        "comment",
+    ]
+    tasks = []
+    for shop_name, sub_df in df_ranked[cols_shop + ["shop"]].groupby("shop"):
         safe_name = shop_name.replace("/", "_").replace(" ", "_")
         out_path = OUTPUT_DIR / f"{safe_name}_ranking.csv"
-        sub_df.to_csv(out_path, index=False)
+        tasks.append((shop_name, sub_df[cols_shop], out_path))
+
+    # 店舗ごとの書き出しは互いに独立なので並列に行う
+    write_csvs_parallel((sub_df, out_path) for _, sub_df, out_path in tasks)
+    for shop_name, _, out_path in tasks:
         print(f"[INFO] 店舗別ランキング → {shop_name} → {out_path}")
 
 if __name__ == "__main__":
@@ -7,13 +7,18 @@ import os
 import yaml
 from dotenv import dotenv_values  # pip install python-dotenv
 
+try:  # libyaml があれば C 実装のパーサを使う
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 CONFIG_DIR = PROJECT_ROOT / "config"
 
 def main():
     # shops.yaml 読み込み
     with open(CONFIG_DIR / "shops.yaml", "r", encoding="utf-8") as f:
-        data = yaml.safe_load(f) or {}
+        data = yaml.load(f, Loader=_YamlLoader) or {}
 
     shops = data.get("shops", [])
 